@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Simulation check of the AIMD controller behind ``--concurrency-mode adaptive``
+
+Drives ``limiter.AdaptiveSemaphore.observe`` with a simulated request stream
+on a fake clock, keeping the limit saturated:
+
+- fixed load: output lengths are lognormal with the given sigmas and the time
+  per output token does not depend on concurrency. The server is never
+  overloaded, so the limit must not end below where it started.
+- overload: the time per output token grows once more than ``--capacity``
+  requests are in flight. The limit must keep backing off before it reaches
+  ``--maximum``.
+- slowdown: the time per output token triples for good after the first third
+  of the run, whatever the concurrency. The limit must climb back to where it
+  started.
+
+Exits with status 1 if either expectation fails.
+
+Usage:
+    python benchmarks/adaptive_limit.py [--initial 64] [--maximum 256] [--sigma 0.3 0.5 0.7 1.0] [--seconds 3600]
+"""
+
+import argparse
+import heapq
+import random
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import limiter
+from limiter import AdaptiveSemaphore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def simulate(initial: int, maximum: int, sigma: float, seconds: float, capacity: int | None,
+             slowdown: float = 1.0, seed: int = 0) -> list[int]:
+    """Limit sampled once per simulated minute."""
+    rng = random.Random(seed)
+    clock = FakeClock()
+    # cooldown の判定も仮想時間で行う
+    limiter.time = clock  # pyright: ignore[reportAttributeAccessIssue]
+    sem = AdaptiveSemaphore(initial=initial, maximum=maximum)
+    in_flight: list[tuple[float, float, int]] = []
+    samples = []
+    next_sample = 60.0
+
+    def start():
+        tokens = max(1, int(rng.lognormvariate(5.5, sigma)))
+        per_token = 0.02 if clock.now < seconds / 3 else 0.02 * slowdown
+        if capacity is not None and len(in_flight) + 1 > capacity:
+            per_token *= (len(in_flight) + 1) / capacity
+        ttft = 0.2 * rng.lognormvariate(0.0, 0.3)
+        heapq.heappush(in_flight, (clock.now + ttft + tokens * per_token, clock.now, tokens))
+
+    while clock.now < seconds:
+        while len(in_flight) < sem.limit:
+            start()
+        finished_at, started_at, tokens = heapq.heappop(in_flight)
+        clock.now = finished_at
+        sem.observe(latency=finished_at - started_at, tokens=tokens)
+        while clock.now >= next_sample:
+            samples.append(sem.limit)
+            next_sample += 60.0
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the adaptive concurrency controller in simulation")
+    parser.add_argument("--initial", type=int, default=64)
+    parser.add_argument("--maximum", type=int, default=256)
+    parser.add_argument("--sigma", type=float, nargs="+", default=[0.3, 0.5, 0.7, 1.0],
+                        help="Spread of the lognormal output length")
+    parser.add_argument("--seconds", type=float, default=3600.0, help="Simulated time per scenario")
+    parser.add_argument("--capacity", type=int, default=96, help="Concurrency at which the overload scenario saturates")
+    args = parser.parse_args()
+
+    ok = True
+    for sigma in args.sigma:
+        samples = simulate(args.initial, args.maximum, sigma, args.seconds, capacity=None)
+        passed = min(samples) >= args.initial
+        ok &= passed
+        print(f"fixed load, sigma {sigma}: limit min {min(samples)}, final {samples[-1]} "
+              f"({'ok' if passed else 'FAIL: shrank without overload'})")
+    samples = simulate(args.initial, args.maximum, 0.7, args.seconds, capacity=args.capacity)
+    settled = samples[len(samples) // 2:]
+    passed = max(settled) < args.maximum
+    ok &= passed
+    print(f"overload at {args.capacity}, sigma 0.7: limit max {max(settled)} in the second half, final {samples[-1]} "
+          f"({'ok' if passed else 'FAIL: did not back off'})")
+    samples = simulate(args.initial, args.maximum, 0.7, args.seconds, capacity=None, slowdown=3.0)
+    passed = samples[-1] >= args.initial
+    ok &= passed
+    print(f"3x slowdown, sigma 0.7: limit min {min(samples)}, final {samples[-1]} "
+          f"({'ok' if passed else 'FAIL: did not recover'})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
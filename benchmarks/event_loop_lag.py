@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Event-loop lag benchmark for database reads
+
+Simulates ``concurrency`` in-flight records that each look up one row (as
+check_language / regenerate_answer do) and then wait on a fake network call,
+while a ticker coroutine measures how late the event loop wakes it up.
+Runs once with blocking ``sqlite3`` reads on the loop and once with
+``database.AsyncReader``.
+
+A temporary database is fully cached by the OS, so reads are CPU-bound and
+cost about the same on either side. ``--io-wait-ms`` adds a GIL-releasing wait
+to each query to model page reads from cold storage (multi-GB result tables).
+
+Usage:
+    python benchmarks/event_loop_lag.py [--concurrency 512] [--rows 100000] [--seconds 10] [--io-wait-ms 0]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from database import AsyncReader
+
+
+def io_wait_function(io_wait: float):
+    def io_wait_fn(_order):
+        # sqliteがディスクを待つ間と同じくGILを解放して待つ
+        time.sleep(io_wait)
+        return 1
+    return io_wait_fn
+
+
+class SlowStorageReader(AsyncReader):
+    def __init__(self, db_path: str, io_wait: float):
+        super().__init__(db_path)
+        self._io_wait = io_wait
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # 関数の登録は接続ごとに1回だけ (クエリごとに登録すると計測が膨らむ)
+            db = super()._connection()
+            db.create_function("io_wait", 1, io_wait_function(self._io_wait))
+        return db
+
+
+QUERY = "SELECT content,source FROM result WHERE id=? AND io_wait(id);"
+
+
+def build_db(db_path: str, rows: int, row_bytes: int):
+    db = sqlite3.connect(db_path)
+    db.execute("CREATE TABLE result(id INT PRIMARY KEY,content TEXT,source TEXT);")
+    payload = "x" * (row_bytes // 2)
+    db.executemany("INSERT INTO result(id, content, source) VALUES (?,?,?);",
+                   ((i, payload, payload) for i in range(rows)))
+    db.commit()
+    db.close()
+
+
+async def measure(read, rows: int, concurrency: int, seconds: float, network_latency: float) -> dict:
+    lags = []
+    reads = 0
+    stop = time.monotonic() + seconds
+
+    async def ticker():
+        interval = 0.005
+        while time.monotonic() < stop:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lags.append(time.monotonic() - started - interval)
+
+    async def worker():
+        nonlocal reads
+        while time.monotonic() < stop:
+            await read(random.randrange(rows))
+            reads += 1
+            await asyncio.sleep(random.uniform(0, network_latency * 2))
+
+    await asyncio.gather(ticker(), *(worker() for _ in range(concurrency)))
+    lags.sort()
+    return {
+        "reads/s": reads / seconds,
+        "lag p50 (ms)": statistics.median(lags) * 1000,
+        "lag p99 (ms)": lags[int(len(lags) * 0.99)] * 1000,
+        "lag max (ms)": lags[-1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Measure event-loop lag caused by database reads")
+    parser.add_argument("--concurrency", type=int, default=512)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--row-bytes", type=int, default=8192)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--network-latency", type=float, default=0.05, help="Mean simulated API latency (s)")
+    parser.add_argument("--io-wait-ms", type=float, default=0.0, help="Simulated storage wait per query (ms)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.sqlite")
+        print(f"Building {args.rows:,} rows of {args.row_bytes:,} bytes...", file=sys.stderr)
+        build_db(db_path, args.rows, args.row_bytes)
+
+        io_wait = args.io_wait_ms / 1000
+        db = sqlite3.connect(db_path)
+        db.create_function("io_wait", 1, io_wait_function(io_wait))
+
+        async def blocking_read(order: int):
+            return db.execute(QUERY, (order,)).fetchone()
+
+        reader = SlowStorageReader(db_path, io_wait)
+
+        async def async_read(order: int):
+            return await reader.fetchone(QUERY, (order,))
+
+        results = {}
+        for name, read in (("blocking", blocking_read), ("AsyncReader", async_read)):
+            print(f"Running {name} for {args.seconds}s at concurrency {args.concurrency}...", file=sys.stderr)
+            results[name] = await measure(read, args.rows, args.concurrency, args.seconds, args.network_latency)
+        reader.close()
+        db.close()
+
+    print(f"{'':<16}" + "".join(f"{name:>14}" for name in results))
+    for metric in next(iter(results.values())):
+        print(f"{metric:<16}" + "".join(f"{values[metric]:>14,.2f}" for values in results.values()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
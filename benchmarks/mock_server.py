@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI-compatible server for offline benchmarks
+
+Implements just enough of the API for the framework to run without a GPU:
+``GET /v1/models`` and ``POST /v1/chat/completions`` with ``stream`` (and
+``stream_options.include_usage``), ``separate_reasoning`` and
+``response_format``. A ``json_schema`` response format is answered with JSON
+generated from the schema (e.g. the one the SDK builds from
+``projects/example_3_chat/model.py``), so ``chat.completions.parse`` succeeds.
+
+The time to first token and the decode rate are drawn per request from the
+configured distributions; the output length follows the prompt length
+(``--output-ratio``) unless ``max_tokens`` is smaller. ``--error-rate`` answers
+that fraction of requests with 503.
+
+Usage:
+    python benchmarks/mock_server.py [--port 30000] [--ttft-ms 200] [--tokens-per-second 50] [--dist exponential]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import resource
+import sys
+import time
+
+# 1トークンあたりの文字数 (usage の概算用)
+CHARS_PER_TOKEN = 4
+# 周期的な文字列は streaming の繰り返し検出に引っかかるので単語をランダムに並べる
+FILLER = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+          "dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+          "commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla").split()
+
+
+class Settings:
+    def __init__(self, args: argparse.Namespace):
+        self.ttft = args.ttft_ms / 1000
+        self.tokens_per_second = args.tokens_per_second
+        self.dist = args.dist
+        self.output_ratio = args.output_ratio
+        self.reasoning_tokens = args.reasoning_tokens
+        self.error_rate = args.error_rate
+        self.chunk_tokens = args.chunk_tokens
+
+    def draw(self, mean: float) -> float:
+        """One sample with the given mean from the configured distribution."""
+        if mean <= 0:
+            return 0.0
+        if self.dist == "fixed":
+            return mean
+        if self.dist == "exponential":
+            return random.expovariate(1 / mean)
+        # lognormal: sigma 0.5, 平均が mean になるように mu を決める
+        sigma = 0.5
+        return random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+
+
+def filler_text(chars: int) -> str:
+    words = []
+    length = 0
+    while length < chars:
+        word = random.choice(FILLER)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def count_strings(value) -> int:
+    if isinstance(value, str):
+        return 1
+    if isinstance(value, dict):
+        return sum(count_strings(item) for item in value.values())
+    if isinstance(value, list):
+        return sum(count_strings(item) for item in value)
+    return 0
+
+
+def from_schema(schema: dict, root: dict, string_chars: int, depth: int = 0):
+    """A value that validates against ``schema`` (the subset pydantic emits: $ref, anyOf, objects, arrays, scalars)."""
+    if "$ref" in schema:
+        name = schema["$ref"].rsplit("/", 1)[-1]
+        return from_schema(root.get("$defs", root.get("definitions", {}))[name], root, string_chars, depth)
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "const" in schema:
+        return schema["const"]
+    options = schema.get("anyOf") or schema.get("oneOf")
+    if options:
+        # Optional[...] は null 以外を選ぶ
+        non_null = [option for option in options if option.get("type") != "null"]
+        return from_schema((non_null or options)[0], root, string_chars, depth)
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    if kind == "object" or "properties" in schema:
+        return {name: from_schema(prop, root, string_chars, depth + 1)
+                for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        count = 0 if depth > 6 else 3
+        return [from_schema(schema.get("items", {}), root, string_chars, depth + 1) for _ in range(count)]
+    if kind == "string":
+        return filler_text(string_chars)
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    if kind == "null":
+        return None
+    # 型指定なし (Any)
+    return None
+
+
+def prompt_chars(body: dict) -> int:
+    total = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            total += sum(len(part.get("text", "")) for part in content if isinstance(part, dict))
+    return total
+
+
+def make_output(body: dict, settings: Settings) -> tuple[str, int]:
+    """Content of the answer and the number of completion tokens it stands for."""
+    chars = prompt_chars(body)
+    tokens = max(1, int(chars / CHARS_PER_TOKEN * settings.output_ratio))
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+    if max_tokens:
+        tokens = min(tokens, max_tokens)
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"].get("schema", {})
+        # 文字列の長さで出力全体がおおよそ目標の長さになるようにする
+        strings = max(1, count_strings(from_schema(schema, schema, 1)))
+        string_chars = max(1, tokens * CHARS_PER_TOKEN // strings)
+        return json.dumps(from_schema(schema, schema, string_chars), ensure_ascii=False), tokens
+    if response_format.get("type") == "json_object":
+        return json.dumps({"content": filler_text(tokens * CHARS_PER_TOKEN)}), tokens
+    return filler_text(tokens * CHARS_PER_TOKEN), tokens
+
+
+def usage(body: dict, completion_tokens: int, reasoning_tokens: int) -> dict:
+    prompt_tokens = max(1, prompt_chars(body) // CHARS_PER_TOKEN)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens + reasoning_tokens,
+        "total_tokens": prompt_tokens + completion_tokens + reasoning_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+        "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+    }
+
+
+_ids = itertools.count()
+
+
+def _response(status: str, body: bytes, content_type: str = "application/json") -> bytes:
+    return (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n").encode() + body
+
+
+async def chat_completion(body: dict, settings: Settings, writer: asyncio.StreamWriter):
+    content, tokens = make_output(body, settings)
+    reasoning_tokens = settings.reasoning_tokens if body.get("separate_reasoning") else 0
+    reasoning = filler_text(reasoning_tokens * CHARS_PER_TOKEN) if reasoning_tokens else None
+    rate = settings.draw(settings.tokens_per_second)
+    decode = (tokens + reasoning_tokens) / rate if rate > 0 else 0.0
+    ttft = settings.draw(settings.ttft)
+    completion_id = f"chatcmpl-mock-{next(_ids)}"
+    model = body.get("model", "mock")
+    if not body.get("stream"):
+        await asyncio.sleep(ttft + decode)
+        message = {"role": "assistant", "content": content}
+        if reasoning is not None:
+            message["reasoning_content"] = reasoning
+        payload = {"id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                   "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                   "usage": usage(body, tokens, reasoning_tokens)}
+        writer.write(_response("200 OK", json.dumps(payload, ensure_ascii=False).encode()))
+        return
+
+    def chunk(delta: dict, finish_reason: str | None = None) -> bytes:
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                   "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        return b"%x\r\ndata: %s\n\n\r\n" % (len(data) + 8, data)
+
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n"
+                 b"Connection: keep-alive\r\n\r\n")
+    await asyncio.sleep(ttft)
+    writer.write(chunk({"role": "assistant", "content": ""}))
+    per_token = decode / max(1, tokens + reasoning_tokens)
+    # chunk_tokens トークンずつまとめて送る
+    pieces = []
+    if reasoning:
+        step = max(1, len(reasoning) * settings.chunk_tokens // reasoning_tokens)
+        pieces += [("reasoning_content", reasoning[i:i + step]) for i in range(0, len(reasoning), step)]
+    step = max(1, len(content) * settings.chunk_tokens // max(1, tokens))
+    pieces += [("content", content[i:i + step]) for i in range(0, len(content), step)]
+    for key, piece in pieces:
+        await asyncio.sleep(per_token * settings.chunk_tokens)
+        writer.write(chunk({key: piece}))
+        await writer.drain()
+    writer.write(chunk({}, "stop"))
+    if (body.get("stream_options") or {}).get("include_usage"):
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                   "model": model, "choices": [], "usage": usage(body, tokens, reasoning_tokens)}
+        data = json.dumps(payload).encode()
+        writer.write(b"%x\r\ndata: %s\n\n\r\n" % (len(data) + 8, data))
+    writer.write(b"e\r\ndata: [DONE]\n\n\r\n0\r\n\r\n")
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, settings: Settings):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target = request_line.decode("latin-1").split()[:2]
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            raw = await reader.readexactly(length) if length else b""
+            path = target.split("?")[0]
+            if method == "GET" and path.endswith("/models"):
+                writer.write(_response("200 OK", b'{"object":"list","data":[{"id":"mock","object":"model"}]}'))
+            elif method == "POST" and path.endswith("/chat/completions"):
+                if random.random() < settings.error_rate:
+                    writer.write(_response("503 Service Unavailable", b'{"error":{"message":"mock overload"}}'))
+                else:
+                    await chat_completion(json.loads(raw), settings, writer)
+            else:
+                writer.write(_response("404 Not Found", b'{"error":{"message":"not found"}}'))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def raise_open_files_limit():
+    # 4096並列では既定の1024では足りない
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=30000)
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="Mean time to first token (ms)")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0,
+                        help="Mean decode rate per request (0 answers instantly)")
+    parser.add_argument("--dist", choices=["fixed", "exponential", "lognormal"], default="lognormal",
+                        help="Distribution of the time to first token and the decode rate")
+    parser.add_argument("--output-ratio", type=float, default=1.0, help="Output tokens per prompt token")
+    parser.add_argument("--reasoning-tokens", type=int, default=0,
+                        help="Reasoning tokens returned as reasoning_content when separate_reasoning is set")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--chunk-tokens", type=int, default=8, help="Tokens per streamed chunk")
+    return parser
+
+
+async def serve(args: argparse.Namespace):
+    raise_open_files_limit()
+    settings = Settings(args)
+    server = await asyncio.start_server(lambda r, w: handle(r, w, settings), args.host, args.port, backlog=8192)
+    print(f"mock server listening on http://{args.host}:{args.port}/v1", file=sys.stderr, flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(build_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
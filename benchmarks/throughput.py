@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Framework throughput benchmark against the mock server
+
+Starts ``benchmarks/mock_server.py`` and runs ``main.py --project
+mock_benchmark`` against it once per concurrency level, each time into a fresh
+temporary database. Reports records/s and the CPU time spent per record by
+the framework process (user + system, from ``RUSAGE_CHILDREN``) and by the
+mock server, so regressions in the client, scheduler or writer paths show up
+without a GPU. With ``--ttft-ms 0 --tokens-per-second 0`` the server answers
+at once and the run measures the framework's own ceiling.
+
+Extra arguments after ``--`` are passed to ``main.py`` (e.g. ``-- --stream``).
+
+Usage:
+    python benchmarks/throughput.py [--concurrency 1 4 16 64 256 1024 4096] [--records 2000] [--ttft-ms 200] [-- main.py args]
+"""
+
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_listening(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"mock server did not start on port {port}")
+
+
+def process_cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a running process (Linux /proc)."""
+    with open(f"/proc/{pid}/stat") as f:
+        # comm に空白が含まれうるので ")" の後ろから数える
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def raise_open_files_limit():
+    # 子プロセスに引き継がれる (4096並列では既定の1024では足りない)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_main(port: int, concurrency: int, records: int, prompt_chars: int, extra: list[str]) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "BASE_URL": f"http://127.0.0.1:{port}/v1",
+            "API_KEY": "mock",
+            "MODEL_NAME": "mock",
+            "BENCHMARK_DB": path.join(tmp, "db.sqlite"),
+            "BENCHMARK_RECORDS": str(records),
+            "BENCHMARK_PROMPT_CHARS": str(prompt_chars),
+        }
+        command = [sys.executable, path.join(ROOT, "main.py"), "--project", "mock_benchmark",
+                   "--concurrency", str(concurrency), *extra]
+        cpu_before = children_cpu_seconds()
+        started = time.monotonic()
+        result = subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                text=True)
+        wall = time.monotonic() - started
+        cpu = children_cpu_seconds() - cpu_before
+        if result.returncode != 0:
+            raise RuntimeError(f"main.py failed at concurrency {concurrency}:\n{result.stderr[-2000:]}")
+    return {"wall": wall, "cpu": cpu}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure framework throughput against the mock server")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64, 256, 1024, 4096])
+    parser.add_argument("--records", type=int, default=2000, help="Records per run (at least the concurrency)")
+    parser.add_argument("--prompt-chars", type=int, default=2000)
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="Mean time to first token of the mock (ms)")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Mean decode rate of the mock (0 answers right after the first token)")
+    parser.add_argument("--dist", choices=["fixed", "exponential", "lognormal"], default="lognormal")
+    parser.add_argument("--output-ratio", type=float, default=0.5)
+    parser.add_argument("main_args", nargs="*", help="Arguments passed to main.py (after --)")
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    port = free_port()
+    server = subprocess.Popen([sys.executable, path.join(ROOT, "benchmarks", "mock_server.py"), "--port", str(port),
+                               "--ttft-ms", str(args.ttft_ms), "--tokens-per-second", str(args.tokens_per_second),
+                               "--dist", args.dist, "--output-ratio", str(args.output_ratio)],
+                              stderr=subprocess.DEVNULL)
+    results = {}
+    try:
+        wait_until_listening(port)
+        for concurrency in args.concurrency:
+            records = max(args.records, concurrency)
+            print(f"Running {records:,} records at concurrency {concurrency}...", file=sys.stderr)
+            server_before = process_cpu_seconds(server.pid)
+            run = run_main(port, concurrency, records, args.prompt_chars, args.main_args)
+            server_cpu = process_cpu_seconds(server.pid) - server_before
+            results[concurrency] = {
+                "records/s": records / run["wall"],
+                "wall (s)": run["wall"],
+                "cpu ms/record": run["cpu"] / records * 1000,
+                "cpu util (%)": run["cpu"] / run["wall"] * 100,
+                "mock ms/record": server_cpu / records * 1000,
+            }
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{'concurrency':<16}" + "".join(f"{concurrency:>12}" for concurrency in results))
+    for metric in next(iter(results.values()), {}):
+        print(f"{metric:<16}" + "".join(f"{values[metric]:>12,.2f}" for values in results.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+import httpx
+
+# (status, headers, body)
+Entry = tuple[int, list[tuple[str, str]], bytes]
+
+# リクエストに影響しないキー
+_IGNORED_KEYS = ("user", "metadata", "store", "stream_options")
+# 保存すると再生時に食い違うヘッダー
+_DROPPED_HEADERS = ("content-length", "transfer-encoding", "connection", "keep-alive", "date")
+
+# warming() 中は API を呼ばずにこのレスポンスを保存する
+_warm_response: ContextVar[dict[str, Any] | None] = ContextVar("_warm_response", default=None)
+# 直前のリクエストに API を呼ばずに応答したか (retry.py が遅延の観測から除く)
+served_locally: ContextVar[bool] = ContextVar("served_locally", default=False)
+
+
+def completion_response(message: dict[str, Any], model: str = "") -> dict[str, Any]:
+    """Minimal ``chat.completion`` body whose only choice is ``message``."""
+    return {
+        "id": "cache-warm",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {**message, "role": "assistant"}}],
+    }
+
+
+@contextmanager
+def warming(response: dict[str, Any]):
+    """Within this block a cacheable request is not sent; ``response`` is stored as its answer instead."""
+    if _cache is None:
+        # キャッシュ無しでは実際にリクエストが送られてしまう
+        raise RuntimeError("warming() needs the response cache (--cache)")
+    token = _warm_response.set(response)
+    try:
+        yield
+    finally:
+        _warm_response.reset(token)
+
+
+class ResponseCache:
+    """On-disk cache of chat completion responses, keyed by request fingerprint.
+
+    The fingerprint is a SHA-256 of the canonical JSON request body, so it covers
+    the model, the messages, the ``response_format`` schema and every sampling
+    parameter. Entries are evicted least-recently-used once their total size
+    exceeds ``max_bytes``. With ``deterministic_only`` only requests sent with
+    ``temperature`` 0 are cached. Streaming requests are never cached.
+    All sqlite work runs on one dedicated thread.
+    """
+
+    def __init__(self, db_path: str, max_bytes: int = 1 << 30, deterministic_only: bool = False):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.deterministic_only = deterministic_only
+        self.hits = 0
+        self.misses = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        self._db: sqlite3.Connection | None = None
+        self._total = 0
+
+    def _connect(self):
+        if self._db is not None:
+            return
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL;")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache("
+                         "key TEXT PRIMARY KEY,status INT,headers TEXT,body BLOB,size INT,last_used REAL);")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used);")
+        self._db.commit()
+        self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache;").fetchone()[0]
+
+    def fingerprint(self, request: httpx.Request) -> str | None:
+        """Cache key of ``request``, or ``None`` when it must not be cached."""
+        if request.method != "POST" or not request.url.path.endswith("/chat/completions"):
+            return None
+        try:
+            body = json.loads(request.content)
+        except (httpx.RequestNotRead, ValueError):
+            return None
+        if not isinstance(body, dict) or body.get("stream"):
+            return None
+        if self.deterministic_only and body.get("temperature") != 0:
+            return None
+        for key in _IGNORED_KEYS:
+            body.pop(key, None)
+        canonical = json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _get(self, key: str) -> Entry | None:
+        self._connect()
+        row = self._db.execute("SELECT status, headers, body FROM cache WHERE key=?;", (key,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE cache SET last_used=? WHERE key=?;", (time.time(), key))
+        self._db.commit()
+        return row[0], json.loads(row[1]), row[2]
+
+    def _put(self, key: str, entry: Entry):
+        self._connect()
+        status, headers, body = entry
+        old = self._db.execute("SELECT size FROM cache WHERE key=?;", (key,)).fetchone()
+        self._db.execute("REPLACE INTO cache(key, status, headers, body, size, last_used) VALUES(?,?,?,?,?,?);",
+                         (key, status, json.dumps(headers), body, len(body), time.time()))
+        self._total += len(body) - (old[0] if old is not None else 0)
+        if self._total > self.max_bytes:
+            # 古いものから1割余裕ができるまで消す
+            target = self.max_bytes * 0.9
+            for old_key, size in self._db.execute("SELECT key, size FROM cache ORDER BY last_used;").fetchall():
+                if self._total <= target:
+                    break
+                self._db.execute("DELETE FROM cache WHERE key=?;", (old_key,))
+                self._total -= size
+        self._db.commit()
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def get(self, key: str) -> Entry | None:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._get, key)
+
+    async def put(self, key: str, entry: Entry):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._put, key, entry)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=False)
+
+
+def _response(entry: Entry, hit: bool) -> httpx.Response:
+    status, headers, body = entry
+    response = httpx.Response(status, headers=headers, content=body)
+    response.headers["x-response-cache"] = "hit" if hit else "miss"
+    return response
+
+
+class CachingTransport(httpx.AsyncBaseTransport):
+    """Answers repeated chat completion requests from a ``ResponseCache``.
+
+    Identical requests in flight at the same time share one API call: the first
+    one is sent, the others wait for its response (and send their own request
+    if it fails). Only 200 responses are stored.
+    """
+
+    def __init__(self, cache: ResponseCache, transport: httpx.AsyncBaseTransport):
+        self._cache = cache
+        self._transport = transport
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key = self._cache.fingerprint(request)
+        warm = _warm_response.get()
+        if warm is not None:
+            entry = (200, [("content-type", "application/json")], json.dumps(warm, ensure_ascii=False).encode())
+            # キャッシュ対象外 (--cache-deterministic-only など) でも送信はしない
+            if key is not None:
+                await self._cache.put(key, entry)
+            served_locally.set(True)
+            return _response(entry, hit=False)
+        if key is None:
+            return await self._transport.handle_async_request(request)
+        while True:
+            entry = await self._cache.get(key)
+            if entry is not None:
+                self._cache.hits += 1
+                served_locally.set(True)
+                return _response(entry, hit=True)
+            leader = self._inflight.get(key)
+            if leader is None:
+                break
+            # 同じリクエストが実行中なら結果を共有する
+            entry = await asyncio.shield(leader)
+            if entry is not None:
+                self._cache.hits += 1
+                served_locally.set(True)
+                return _response(entry, hit=True)
+        self._cache.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        entry = None
+        try:
+            response = await self._transport.handle_async_request(request)
+            if response.status_code != 200:
+                return response
+            try:
+                body = b"".join([chunk async for chunk in response.stream])
+            finally:
+                await response.aclose()
+            headers = [(name, value) for name, value in response.headers.multi_items()
+                       if name.lower() not in _DROPPED_HEADERS]
+            entry = (response.status_code, headers, body)
+            await self._cache.put(key, entry)
+            return _response(entry, hit=False)
+        finally:
+            del self._inflight[key]
+            future.set_result(entry)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+# main.py の configure() で設定される
+_cache: ResponseCache | None = None
+
+
+def configure(db_path: str | None, max_bytes: int = 1 << 30, deterministic_only: bool = False):
+    """Enable the cache for clients created afterwards (``db_path`` of ``None`` disables it)."""
+    global _cache
+    _cache = ResponseCache(db_path, max_bytes, deterministic_only) if db_path is not None else None
+
+
+def wrap(transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    return CachingTransport(_cache, transport) if _cache is not None else transport
+
+
+async def close():
+    if _cache is not None:
+        if _cache.hits or _cache.misses:
+            print(f"response cache: {_cache.hits} hit(s), {_cache.misses} miss(es)")
+        await _cache.close()
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+
+def is_outage_error(e: BaseException) -> bool:
+    """Connection failures and gateway errors, i.e. the backend is not reachable.
+
+    Read timeouts are not included: one slow or stuck request says nothing
+    about the rest of the backend (they are still retried by ``call_with_retry``).
+    """
+    if isinstance(e, APITimeoutError):
+        return False
+    if isinstance(e, APIConnectionError):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code in (502, 503, 504)
+    return False
+
+
+class CircuitBreaker:
+    """Process-wide switch that stops dispatch while the backend is down.
+
+    The breaker opens after consecutive outage errors from ``threshold``
+    different calls (any other response, including a non-outage error, resets
+    the count); retries of a single call count once, so one bad record cannot
+    pause the whole run. A call that runs out of attempts on an outage error
+    opens it through ``trip`` instead of failing its record. While it is open the scheduler dispatches no new
+    records and failing calls wait for it instead of spending their retries.
+    A background probe calls the backend every ``probe_interval`` seconds and
+    closes the breaker on the first success. ``threshold`` of 0 disables the
+    breaker.
+    """
+
+    def __init__(self, threshold: int = 8, probe_interval: float = 5.0):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        # 連続して失敗している呼び出し (call_with_retry の呼び出しごとのキー)
+        self._failing_calls: set[object] = set()
+        self._closed = asyncio.Event()
+        self._closed.set()
+        self._probe: Callable[[], Awaitable[object]] | None = None
+        self._probe_task: asyncio.Task | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return not self._closed.is_set()
+
+    def set_probe(self, probe: Callable[[], Awaitable[object]]):
+        """Cheap request used to check whether the backend is back."""
+        self._probe = probe
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    def record_success(self):
+        self._failing_calls.clear()
+
+    def record_failure(self, e: BaseException, call: object) -> bool:
+        """Count ``e`` raised by ``call`` and return whether the breaker is open afterwards."""
+        if self.threshold <= 0:
+            return False
+        if not is_outage_error(e):
+            # 応答が返ってきているのでバックエンドは生きている
+            self._failing_calls.clear()
+            return self.is_open
+        if self.is_open:
+            return True
+        self._failing_calls.add(call)
+        if len(self._failing_calls) >= self.threshold:
+            self._trip(e)
+        return self.is_open
+
+    def trip(self, e: BaseException) -> bool:
+        """Open the breaker for a call that ran out of attempts on ``e``; returns False when it is disabled."""
+        if self.threshold <= 0:
+            return False
+        if not self.is_open:
+            self._trip(e)
+        return True
+
+    def _trip(self, e: BaseException):
+        print(f"circuit breaker opened after failures from {len(self._failing_calls)} call(s): {e!r}, "
+              f"pausing dispatch")
+        self._closed.clear()
+        self._probe_task = asyncio.create_task(self._run_probe())
+
+    async def _run_probe(self):
+        opened_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            if self._probe is None:
+                # プローブが無い場合は一定時間後に再開して様子を見る
+                break
+            try:
+                await self._probe()
+                break
+            except Exception as e:
+                print(f"circuit breaker: backend still down ({type(e).__name__}), "
+                      f"{time.monotonic() - opened_at:.0f}s since opened")
+        print(f"circuit breaker closed after {time.monotonic() - opened_at:.0f}s, resuming dispatch")
+        self._failing_calls.clear()
+        self._closed.set()
+
+
+# プロセス全体で1つ (main.py の configure() で設定される)
+breaker = CircuitBreaker()
+
+
+def configure(threshold: int = 8, probe_interval: float = 5.0):
+    breaker.threshold = max(0, threshold)
+    breaker.probe_interval = probe_interval
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import random
+import re
+import time
+
+import httpx
+from openai import AsyncOpenAI
+
+import cache
+import metrics
+import usage
+from circuit import breaker
+from core import current_order
+
+# main.py の configure() で上書きされる
+_pool_size = 64
+_http2 = False
+_connect_timeout = 10.0
+_read_timeout = 1800.0
+_min_tokens_per_second = 10.0
+_affinity = False
+
+
+def configure(pool_size: int, http2: bool = False, connect_timeout: float = 10.0, read_timeout: float = 1800.0,
+              min_tokens_per_second: float = 10.0, affinity: bool = False):
+    """Settings for clients created afterwards. main.py calls this before constructing the task."""
+    global _pool_size, _http2, _connect_timeout, _read_timeout, _min_tokens_per_second, _affinity
+    _pool_size = max(1, pool_size)
+    _http2 = http2
+    _connect_timeout = connect_timeout
+    _read_timeout = read_timeout
+    _min_tokens_per_second = min_tokens_per_second
+    _affinity = affinity
+
+
+def _default_timeout() -> httpx.Timeout:
+    return httpx.Timeout(connect=_connect_timeout, read=_read_timeout, write=_connect_timeout, pool=None)
+
+
+def request_timeout(expected_output_tokens: int) -> httpx.Timeout:
+    """Per-request deadline scaled to the expected output length.
+
+    Without streaming the server sends nothing until generation is finished, so
+    the read timeout bounds the whole request. It is ``--read-timeout`` plus the
+    time to generate ``expected_output_tokens`` at ``--min-tokens-per-second``.
+    Character counts can be passed as an upper bound for the token count.
+    """
+    read = _read_timeout + expected_output_tokens / _min_tokens_per_second
+    return httpx.Timeout(connect=_connect_timeout, read=read, write=_connect_timeout, pool=None)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def split_base_urls(base_url: str | list[str]) -> list[str]:
+    """``BASE_URL`` may list several endpoints separated by commas or whitespace."""
+    urls = base_url if isinstance(base_url, list) else re.split(r"[,\s]+", base_url)
+    return [url.rstrip("/") for url in urls if url.strip()]
+
+
+class _Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Response body that returns its endpoint's outstanding slot when closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, endpoint: _Endpoint):
+        self._stream = stream
+        self._endpoint = endpoint
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._released:
+            self._released = True
+            self._endpoint.outstanding -= 1
+        await self._stream.aclose()
+
+
+# --metrics-port で振り分け先の状態を出すために BalancingTransport が登録する
+_endpoints: list[_Endpoint] = []
+
+
+def endpoint_health() -> dict[tuple[str, ...], float]:
+    """1 for every balanced endpoint in rotation, 0 while it is ejected, keyed like the request metrics."""
+    now = time.monotonic()
+    health = {}
+    for endpoint in _endpoints:
+        url = httpx.URL(endpoint.url)
+        health[(f"{url.scheme}://{url.netloc.decode('ascii')}",)] = float(endpoint.ejected_until <= now)
+    return health
+
+
+class BalancingTransport(httpx.AsyncBaseTransport):
+    """Spreads requests over several OpenAI-compatible endpoints.
+
+    The OpenAI client is built with the first endpoint as its base URL and every
+    request is rewritten to the endpoint with the fewest outstanding requests
+    (a request is outstanding until its response body is closed). An endpoint
+    that fails ``eject_after`` times in a row (connection error or 502/503/504)
+    is left out for ``eject_seconds``, then tried again. With ``affinity`` all
+    requests of one record go to the same endpoint, chosen by rendezvous hashing
+    of the record order over the healthy endpoints, so multi-turn records keep
+    hitting the server's prefix cache.
+    """
+
+    def __init__(self, urls: list[str], transport: httpx.AsyncBaseTransport, affinity: bool = False,
+                 eject_after: int = 3, eject_seconds: float = 30.0):
+        self._endpoints = [_Endpoint(url) for url in urls]
+        _endpoints.extend(self._endpoints)
+        self._primary = urls[0] + "/"
+        self._transport = transport
+        self._affinity = affinity
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+
+    def _healthy(self) -> list[_Endpoint]:
+        now = time.monotonic()
+        healthy = [e for e in self._endpoints if e.ejected_until <= now]
+        # 全滅時は最も早く復帰するものに送る (停止の判断はサーキットブレーカーに任せる)
+        return healthy or [min(self._endpoints, key=lambda e: e.ejected_until)]
+
+    def _choose(self) -> _Endpoint:
+        healthy = self._healthy()
+        order = current_order.get()
+        if self._affinity and order is not None:
+            return max(healthy, key=lambda e: hashlib.blake2b(f"{order}|{e.url}".encode(), digest_size=8).digest())
+        least = min(e.outstanding for e in healthy)
+        return random.choice([e for e in healthy if e.outstanding == least])
+
+    def _failed(self, endpoint: _Endpoint):
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_after and endpoint.ejected_until <= time.monotonic():
+            print(f"endpoint {endpoint.url} ejected for {self.eject_seconds:.0f}s after {endpoint.failures} failure(s)")
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+            endpoint.failures = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self._choose()
+        url = str(request.url)
+        if url.startswith(self._primary):
+            request.url = httpx.URL(endpoint.url + "/" + url[len(self._primary):])
+            request.headers["Host"] = request.url.netloc.decode("ascii")
+        endpoint.outstanding += 1
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException as e:
+            endpoint.outstanding -= 1
+            if isinstance(e, httpx.TransportError):
+                self._failed(endpoint)
+            raise
+        if response.status_code in (502, 503, 504):
+            self._failed(endpoint)
+        else:
+            endpoint.failures = 0
+        response.stream = _ReleasingStream(response.stream, endpoint)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def create_client(api_key: str | None = None, base_url: str | list[str] | None = None) -> AsyncOpenAI:
+    """AsyncOpenAI whose connection pool is sized to the scheduler's concurrency.
+
+    ``api_key`` / ``base_url`` default to the ``API_KEY`` / ``BASE_URL`` environment variables.
+    When several base URLs are given, requests are balanced over them by ``BalancingTransport``.
+    """
+    http2 = _http2
+    if http2 and not _http2_available():
+        print("HTTP/2 needs the h2 package (pip install 'httpx[http2]'), falling back to HTTP/1.1")
+        http2 = False
+    urls = split_base_urls(base_url or os.environ["BASE_URL"])
+    transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=_pool_size, max_keepalive_connections=_pool_size, keepalive_expiry=120.0),
+        http2=http2,
+    )
+    # 振り分け後の実際の送信先ごとに数える
+    transport = metrics.wrap(transport)
+    if len(urls) > 1:
+        transport = BalancingTransport(urls, transport, affinity=_affinity)
+    # キャッシュヒットは振り分け・使用量の集計より前に返す (トークンを消費しない)
+    transport = cache.wrap(usage.wrap(transport))
+    http_client = httpx.AsyncClient(transport=transport, timeout=_default_timeout())
+    openai_client = AsyncOpenAI(
+        api_key=api_key or os.environ["API_KEY"],
+        base_url=urls[0],
+        http_client=http_client,
+        timeout=_default_timeout(),
+        # 再試行は retry.call_with_retry に一本化する
+        max_retries=0,
+    )
+    # サーキットブレーカーの復旧確認には軽い /models を使う
+    breaker.set_probe(lambda: openai_client.models.list(timeout=_connect_timeout))
+    return openai_client
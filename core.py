@@ -1,12 +1,30 @@
+import json
+import sqlite3
 from abc import ABC, abstractmethod
 from asyncio import Semaphore
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Iterable
 
 import tqdm
 from datasets import IterableDataset, Dataset
 
+# 現在のコルーチンが処理しているレコードのorder (scheduler が process() の前に設定する)
+current_order: ContextVar[int | None] = ContextVar("current_order", default=None)
+
+
+@dataclass(frozen=True)
+class ResultRow:
+    """One result returned from ``process()``; written as ``REPLACE INTO table(columns...)``."""
+    table: str
+    values: dict[str, Any]
+
 
 class InferenceTask(ABC):
     dataset: IterableDataset | Dataset | range | list
+    # 結果を保存するDBとテーブル (レジューム時の完了判定に使う)
+    db_path: str | None = None
+    result_table: str | None = None
 
     @abstractmethod
     def __init__(self):
@@ -21,5 +39,85 @@ class InferenceTask(ABC):
         pass
 
     @abstractmethod
-    async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm):
+    async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm) -> ResultRow | None:
+        """Process one record. A returned row is committed to ``db_path`` by the framework's writer.
+
+        ``data`` is the record as returned by ``prepare()``.
+        """
         pass
+
+    def prepare(self, data) -> Any:
+        """CPU-bound preprocessing of one record (serializing, parsing, building prompts), run before ``process()``.
+
+        The framework calls it off the event loop in a worker pool, ahead of
+        dispatch (``--prepare-workers``), and passes the return value to
+        ``process()``. It must not touch the event loop or the API client. A
+        ``@staticmethod`` implementation can also run in a process pool
+        (``--prepare-pool process``). The default returns the record unchanged.
+        """
+        return data
+
+    def estimate_tokens(self, data) -> int:
+        """Estimated prompt + completion tokens of one record, reserved against ``--token-budget``.
+
+        The default assumes about 3 characters per token and a completion as long as the prompt.
+        """
+        try:
+            chars = len(json.dumps(data, ensure_ascii=False, default=str))
+        except (TypeError, ValueError):
+            chars = len(str(data))
+        return chars // 3 * 2 + 1
+
+    def observed_lengths(self) -> Iterable[tuple[int, int]]:
+        """``(source length, content length)`` of stored results, used to refine ``--order longest-first``."""
+        if self.db_path is None or self.result_table is None:
+            return
+        db = sqlite3.connect(self.db_path)
+        try:
+            yield from db.execute(f"SELECT length(source), length(content) FROM {self.result_table};")
+        except sqlite3.OperationalError:
+            # source/content列が無いテーブル
+            return
+        finally:
+            db.close()
+
+    def result_id(self, data, order: int) -> Any:
+        """``id`` under which ``process()`` stores the result of a record, also used for its ``*_usage`` row.
+
+        ``data`` is the record as passed to ``process()``. The default is the row
+        order; override it together with ``completed_orders()`` when the task
+        keys its results by something else.
+        """
+        return order
+
+    def translation_units(self, data) -> Iterable[str]:
+        """Texts of one record that are translated independently of the rest (``--dedup``).
+
+        ``process()`` must route each of them through ``dedup.deduplicator.once()``.
+        The default has none, which disables deduplication for the task.
+        """
+        return ()
+
+    async def warm_cache(self) -> int:
+        """Fill the response cache from results already stored in ``db_path`` (``--cache-warm``).
+
+        Tasks that can rebuild their requests from ``result_table`` override this and
+        issue each request inside ``cache.warming(response)``, which stores the
+        response without calling the API. Returns the number of requests stored.
+        """
+        return 0
+
+    def completed_orders(self) -> Iterable[int]:
+        """Orders that already have a result. main.py skips them before scheduling.
+
+        The default reads every ``id`` of ``result_table`` in ``db_path`` in one scan;
+        override it when ids are not the row order.
+        """
+        if self.db_path is None or self.result_table is None:
+            return
+        db = sqlite3.connect(self.db_path)
+        try:
+            for (order,) in db.execute(f"SELECT id FROM {self.result_table};"):
+                yield order
+        finally:
+            db.close()
@@ -0,0 +1,158 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from asyncio import Queue
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+import tracing
+from core import ResultRow
+
+# writerの終了通知
+_CLOSE = object()
+
+
+class WriterError(Exception):
+    """The result writer failed to commit a batch; raised to every later ``put`` and to ``close``."""
+
+
+class AsyncReader:
+    """Awaitable read queries run on a dedicated thread pool, one connection per thread.
+
+    Keeps blocking ``sqlite3`` calls (and the page reads behind them) off the
+    event loop so in-flight HTTP handling is not stalled by lookups.
+    """
+
+    def __init__(self, db_path: str, workers: int = 4):
+        self._db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._local.db = db
+            self._connections.append(db)
+        return db
+
+    def _fetchone(self, sql: str, params: tuple):
+        return self._connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple):
+        return self._connection().execute(sql, params).fetchall()
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._fetchone, sql, params)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._fetchall, sql, params)
+
+    def close(self):
+        self._executor.shutdown()
+        for db in self._connections:
+            db.close()
+        self._connections.clear()
+
+
+class ResultWriter:
+    """Single writer that group-commits result rows off the event loop.
+
+    Rows are collected until ``batch_size`` rows or ``flush_interval`` seconds
+    have accumulated, then written with one ``executemany`` per table/column set
+    and one commit on a dedicated thread. The queue holds at most ``max_pending``
+    rows, so ``put`` waits (and the scheduler with it) when storage falls behind.
+    If a batch fails to commit, the writer stops writing and ``put`` / ``close``
+    raise ``WriterError`` so the run fails instead of hanging on a full queue.
+    """
+
+    def __init__(self, db_path: str, batch_size: int = 256, flush_interval: float = 1.0, max_pending: int = 4096):
+        self._db_path = db_path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: Queue = Queue(maxsize=max_pending)
+        # sqliteの接続はこのスレッドだけで使う
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-writer")
+        self._db: sqlite3.Connection | None = None
+        self._runner: asyncio.Task | None = None
+        self._error: BaseException | None = None
+        self.written = 0
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._db = await loop.run_in_executor(self._executor, self._connect)
+        self._runner = asyncio.create_task(self._run())
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self._db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL;")
+        db.execute("PRAGMA synchronous=NORMAL;")
+        return db
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise WriterError(f"result writer failed: {self._error!r}") from self._error
+
+    async def put(self, row: ResultRow):
+        self._raise_if_failed()
+        await self._queue.put(row)
+
+    async def close(self):
+        await self._queue.put(_CLOSE)
+        if self._runner is not None:
+            await self._runner
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown()
+        self._raise_if_failed()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            batch = []
+            entry = await self._queue.get()
+            deadline = time.monotonic() + self._flush_interval
+            while entry is not _CLOSE:
+                batch.append(entry)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), max(0.0, deadline - time.monotonic()))
+                except TimeoutError:
+                    break
+            closing = entry is _CLOSE
+            if batch:
+                start = time.monotonic()
+                try:
+                    await loop.run_in_executor(self._executor, self._write, batch)
+                except Exception as e:
+                    print(f"result writer: failed to write {len(batch)} row(s): {e!r}")
+                    self._error = e
+                    if not closing:
+                        await self._discard()
+                    return
+                self.written += len(batch)
+                tracing.event("db_write", rows=len(batch), duration=time.monotonic() - start, pending=self.pending)
+
+    async def _discard(self):
+        # 失敗後も put() で待っているワーカーを解放する (以降の put() は WriterError になる)
+        while await self._queue.get() is not _CLOSE:
+            pass
+
+    def _write(self, batch: list[ResultRow]):
+        def key(row: ResultRow):
+            return row.table, tuple(row.values.keys())
+
+        for (table, columns), rows in groupby(sorted(batch, key=key), key=key):
+            self._db.executemany(
+                f"REPLACE INTO {table}({','.join(columns)}) VALUES ({','.join('?' * len(columns))});",
+                [tuple(row.values.values()) for row in rows],
+            )
+        self._db.commit()
@@ -18,48 +18,13 @@ Output includes:
 - Distribution analysis
 """
 
-import json
 import numpy as np
 from datasets import load_dataset, get_dataset_config_names
 from typing import Dict, List, Tuple, Optional
 import sys
 import argparse
 
-
-def calculate_prompt_length(data: dict) -> int:
-    """
-    Calculate the length of input_json_str as done in task.py process() method.
-    This replicates the exact logic used in the actual processing.
-    """
-    try:
-        # "extra_info" は dict型
-        if "extra_info" in data and data["extra_info"] is not None:
-            input_json_str = json.dumps(data["extra_info"], ensure_ascii=False, separators=(",", ":"))
-        else:
-            raise KeyError("extra_info")
-    except (KeyError, ValueError, TypeError):
-        # "extra_info" が存在しないかデコードできない場合は他のキーを試行
-        prompt = data.get("prompt") or data.get("query")
-        reward_model = data.get("reward_model")
-        rubrics = data.get("Rubrics") or data.get("rubrics")
-        
-        if prompt is not None:
-            # 取得できたキーで構成する
-            obj = {"prompt": prompt}
-            if reward_model is not None:
-                obj["reward_model"] = reward_model
-            if rubrics is not None:
-                obj["rubrics"] = rubrics
-            
-            input_json_str = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
-        else:
-            # 何も取得できない場合はデータ全体をダンプ（フォールバック）
-            try:
-                input_json_str = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
-            except (ValueError, TypeError):
-                input_json_str = ""
-    
-    return len(input_json_str)
+from ordering import calculate_prompt_length
 
 
 def count_exceeding_threshold(lengths: List[int], threshold: int) -> Tuple[int, float]:
@@ -0,0 +1,118 @@
+import asyncio
+import copy
+import hashlib
+from asyncio import Semaphore
+from typing import Any, Awaitable, Callable, Iterable, TypeVar
+
+from core import InferenceTask
+
+T = TypeVar("T")
+
+# リーダーの呼び出しが失敗したことをフォロワーに伝える
+_FAILED = object()
+
+
+def unit_key(unit: str) -> bytes:
+    return hashlib.blake2b(unit.encode(), digest_size=16).digest()
+
+
+class Deduplicator:
+    """Translates each repeated unit once and shares the result with every occurrence.
+
+    ``scan()`` counts the units of all pending records up front; only units seen
+    more than once are tracked. At run time the first record that reaches such a
+    unit makes the call and the other occurrences wait for it (releasing their
+    concurrency slot meanwhile) and get a deep copy of its result. A shared result
+    is dropped once its last occurrence has taken it. Without ``scan()``,
+    ``once()`` just makes the call.
+
+    Repeated units are translated with the context of the record that reaches
+    them first.
+    """
+
+    def __init__(self):
+        self._remaining: dict[bytes, int] = {}
+        self._results: dict[bytes, asyncio.Future] = {}
+        self.shared = 0
+
+    def scan(self, task: InferenceTask, items: Iterable[tuple[int, Any]]) -> dict[str, int]:
+        """Count the units of ``items`` and return the totals used for the dedup report."""
+        counts: dict[bytes, int] = {}
+        total = 0
+        total_chars = 0
+        unique_chars = 0
+        for _, item in items:
+            for unit in task.translation_units(item):
+                key = unit_key(unit)
+                total += 1
+                total_chars += len(unit)
+                if key not in counts:
+                    counts[key] = 0
+                    unique_chars += len(unit)
+                counts[key] += 1
+        self._remaining = {key: count for key, count in counts.items() if count > 1}
+        return {
+            "units": total,
+            "unique": len(counts),
+            "repeated": len(self._remaining),
+            "chars": total_chars,
+            "unique_chars": unique_chars,
+        }
+
+    def _taken(self, key: bytes):
+        # 最後の出現が受け取ったら解放する
+        remaining = self._remaining.get(key, 0) - 1
+        if remaining > 0:
+            self._remaining[key] = remaining
+        else:
+            self._remaining.pop(key, None)
+            self._results.pop(key, None)
+
+    async def once(self, unit: str, call: Callable[[], Awaitable[T]], sem: Semaphore) -> T:
+        """``await call()`` unless another occurrence of ``unit`` already did (or is doing) it.
+
+        ``sem`` must be held by the caller; it is released while waiting for another record.
+        """
+        key = unit_key(unit)
+        while key in self._remaining:
+            future = self._results.get(key)
+            if future is None:
+                break
+            sem.release()
+            try:
+                result = await asyncio.shield(future)
+            finally:
+                await sem.acquire()
+            if result is not _FAILED:
+                self.shared += 1
+                self._taken(key)
+                return copy.deepcopy(result)
+        if key not in self._remaining:
+            return await call()
+        future = asyncio.get_running_loop().create_future()
+        self._results[key] = future
+        try:
+            result = await call()
+        except BaseException:
+            # 次に来たものが呼び直す
+            del self._results[key]
+            future.set_result(_FAILED)
+            self._taken(key)
+            raise
+        future.set_result(result)
+        self._taken(key)
+        return copy.deepcopy(result)
+
+
+# プロセス全体で1つ (main.py の --dedup で scan される)
+deduplicator = Deduplicator()
+
+
+def report(stats: dict[str, int]) -> str:
+    units = stats["units"]
+    if units == 0:
+        return "dedup: no translation units found"
+    saved = units - stats["unique"]
+    return (f"dedup: {units} units, {stats['unique']} unique ({stats['repeated']} repeated), "
+            f"{saved} calls saved ({saved / units:.1%}), "
+            f"{stats['chars'] - stats['unique_chars']} of {stats['chars']} chars")
@@ -0,0 +1,59 @@
+import asyncio
+from asyncio import Semaphore
+from typing import Any, Awaitable, Callable, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# main.py の configure() で設定される (1 ならレコード内の呼び出しは順番に実行する)
+_width = 1
+
+
+def configure(width: int = 1):
+    global _width
+    _width = max(1, width)
+
+
+async def gather(calls: Sequence[Callable[[], Awaitable[T]]], sem: Semaphore) -> list[T]:
+    """Await the independent ``calls`` of one record and return their results in order.
+
+    ``sem`` must be held by the caller. The caller's slot runs the calls one
+    after another, exactly as a plain loop would. With ``--record-fanout N``,
+    up to ``N - 1`` more calls run at the same time, each on an extra slot
+    acquired from ``sem``, so the fan-out only uses slots that are free and
+    the run stays within ``--concurrency``. If a call raises, the others are
+    cancelled and its exception is re-raised.
+    """
+    results: list[Any] = [None] * len(calls)
+    pending = iter(enumerate(calls))
+
+    async def run():
+        for index, call in pending:
+            results[index] = await call()
+
+    if _width <= 1 or len(calls) <= 1:
+        await run()
+        return results
+
+    waiting: set[asyncio.Task] = set()
+
+    async def run_on_extra_slot():
+        task = asyncio.current_task()
+        waiting.add(task)  # pyright: ignore[reportArgumentType]
+        await sem.acquire()
+        waiting.discard(task)  # pyright: ignore[reportArgumentType]
+        try:
+            await run()
+        finally:
+            sem.release()
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            for _ in range(min(_width, len(calls)) - 1):
+                group.create_task(run_on_extra_slot())
+            await run()
+            # 呼び出しを使い切った後で枠を待っているワーカーは不要
+            for task in waiting:
+                task.cancel()
+    except BaseExceptionGroup as errors:
+        raise errors.exceptions[0]
+    return results
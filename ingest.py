@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Iterable, Iterator
+
+from datasets import IterableDataset
+
+from resume import ResumeIndex
+
+_END = object()
+
+
+def split_size(dataset: IterableDataset) -> int | None:
+    """Number of rows of a streaming dataset's split from its metadata, when the builder recorded it."""
+    splits = dataset.info.splits if dataset.info is not None else None
+    if not splits or dataset.split is None:
+        return None
+    try:
+        return splits[str(dataset.split)].num_examples or None
+    except KeyError:
+        return None
+
+
+class StreamCheckpoints:
+    """``(order, state_dict)`` pairs of a streaming dataset, stored next to the task's DB.
+
+    The reader saves the dataset's ``state_dict()`` every ``every`` rows. On
+    resume, the latest checkpoint at or before the first pending order is
+    loaded with ``load_state_dict()``, so shards that were fully consumed are
+    not downloaded or decoded again.
+    """
+
+    def __init__(self, path: str, every: int = 10_000):
+        self.path = path
+        self.every = every
+        self._points: list[tuple[int, dict]] = []
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self._points = [(order, state) for order, state in json.load(f)]
+
+    def resume_point(self, first_pending: int) -> tuple[int, dict] | None:
+        points = [point for point in self._points if point[0] <= first_pending]
+        return max(points, key=lambda point: point[0]) if points else None
+
+    def add(self, order: int, state: dict):
+        if any(point[0] == order for point in self._points):
+            return
+        self._points.append((order, state))
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._points, f)
+        os.replace(tmp_path, self.path)
+
+
+def stream_items(dataset: IterableDataset, index: ResumeIndex,
+                 checkpoints: StreamCheckpoints | None = None) -> Iterator[tuple[int, Any]]:
+    """(order, item) pairs of a streaming dataset that still need processing.
+
+    Completed rows before the first pending one are skipped from a saved
+    checkpoint when the dataset supports ``state_dict()``, otherwise with
+    ``skip()`` (which still reads them, but off the event loop and without
+    handing them to the scheduler).
+    """
+    first = next(index.pending_ranges(), None)
+    if first is None:
+        return
+    start = 0
+    if checkpoints is not None and hasattr(dataset, "state_dict"):
+        point = checkpoints.resume_point(first.start)
+        if point is not None:
+            start, state = point
+            dataset.load_state_dict(state)
+    else:
+        checkpoints = None
+        if first.start > 0:
+            dataset = dataset.skip(first.start)
+            start = first.start
+    if start:
+        print(f"dataset: resuming the stream at row {start}")
+    for order, item in enumerate(dataset, start):
+        if checkpoints is not None and (order + 1) % checkpoints.every == 0:
+            checkpoints.add(order + 1, dataset.state_dict())
+        if order not in index:
+            yield order, item
+
+
+class Prefetcher:
+    """Reads a blocking iterable in a background thread, buffering up to ``size`` items for the event loop.
+
+    Downloading and decoding the next rows of a dataset then never blocks the
+    loop, and the buffer bounds the rows held in memory ahead of dispatch.
+    An exception raised by the iterable is re-raised to the consumer.
+    """
+
+    def __init__(self, iterable: Iterable, size: int = 256):
+        self._iterable = iterable
+        self._size = max(1, size)
+
+    async def __aiter__(self) -> AsyncIterator:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        slots = threading.Semaphore(self._size)
+        stop = threading.Event()
+
+        def run():
+            try:
+                for item in self._iterable:
+                    # バッファが一杯ならループ側が取り出すまで待つ
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            except BaseException as e:
+                if not stop.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, (_END, e))
+                return
+            if not stop.is_set():
+                loop.call_soon_threadsafe(queue.put_nowait, (_END, None))
+
+        threading.Thread(target=run, name="dataset-prefetch", daemon=True).start()
+        try:
+            while True:
+                item, error = await queue.get()
+                if item is _END:
+                    if error is not None:
+                        raise error
+                    return
+                slots.release()
+                yield item
+        finally:
+            stop.set()
+            # 空きを待っているスレッドを起こして終了させる
+            slots.release()
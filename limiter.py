@@ -0,0 +1,213 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from openai import APIStatusError, APITimeoutError
+
+
+def is_overload_error(e: BaseException) -> bool:
+    """429 / 5xx / timeout, i.e. errors that mean the backend is past its capacity."""
+    if isinstance(e, APITimeoutError):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+
+class AdaptiveSemaphore:
+    """Semaphore whose limit follows additive-increase/multiplicative-decrease.
+
+    It supports the same ``async with`` / ``acquire()`` / ``release()`` usage as
+    ``asyncio.Semaphore``, so it can be handed to ``InferenceTask.process`` as is.
+    ``retry.call_with_retry`` passes the latency and output tokens of every
+    API request to ``observe``; the time a slot is held is not used, since it
+    also covers retry backoff, breaker waits and the task's own work. The
+    signal is the latency per output token, so records that simply generate
+    more do not look slower. The baseline is the lowest per-token latency seen,
+    so a slow climb under load does not drag it along; it is only raised while
+    the limit sits at ``minimum``, where a lasting slowdown of the server itself
+    is accepted. While a short-term average stays close to the baseline the
+    limit grows by ``increase`` per ``limit`` completions. When the short-term
+    average stays above ``spike_ratio`` times the baseline for
+    ``spike_samples`` completions in a row, or an overload error escapes the
+    block (or is passed to ``observe``), the limit is multiplied by
+    ``decrease``. Decreases happen at most once per ``cooldown`` seconds so
+    that a burst of failures from one event only counts once.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 1024, increase: float = 1.0,
+                 decrease: float = 0.7, spike_ratio: float = 2.0, spike_samples: int = 8, cooldown: float = 5.0):
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum)
+        self._limit = float(min(max(initial, self._minimum), self._maximum))
+        self._increase = increase
+        self._decrease = decrease
+        self._spike_ratio = spike_ratio
+        self._spike_samples = max(1, spike_samples)
+        self._cooldown = cooldown
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._fast_latency: float | None = None
+        self._base: float | None = None
+        # 短期平均が閾値を超え続けている回数
+        self._over_threshold = 0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def locked(self) -> bool:
+        return self._in_flight >= self.limit
+
+    async def acquire(self) -> bool:
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 枠を受け取った直後にキャンセルされた場合は返却する
+                self.release()
+            raise
+        return True
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self._in_flight += 1
+            fut.set_result(True)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return None
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        if exc is not None:
+            self.observe(error=exc)
+
+    def observe(self, latency: float | None = None, error: BaseException | None = None, tokens: int | None = None):
+        """Feed one request (latency and output tokens) or one failure into the controller.
+
+        Without ``tokens`` the latency cannot be compared across records, so the
+        sample only counts as a completion.
+        """
+        if error is not None:
+            if is_overload_error(error):
+                self._backoff()
+            return
+        if latency is None:
+            return
+        if tokens is None:
+            self._grow()
+            return
+        # 出力トークンあたりの時間で比べる (生成長の違いを遅延の急増と見なさない)
+        latency /= max(1, tokens)
+        base = self._base_latency(latency)
+        if self._fast_latency is None:
+            self._fast_latency = latency
+        else:
+            self._fast_latency += 0.3 * (latency - self._fast_latency)
+        if self._fast_latency <= base * self._spike_ratio:
+            self._over_threshold = 0
+            self._grow()
+            return
+        self._over_threshold += 1
+        if self._over_threshold >= self._spike_samples:
+            self._backoff()
+
+    def _base_latency(self, latency: float) -> float:
+        if self._base is None or latency < self._base:
+            self._base = latency
+        elif self.limit <= self._minimum:
+            # limit を下げきっても遅いままならサーバ自体が遅くなったとみなして基準を引き上げる
+            self._base += 0.3 * (latency - self._base)
+        return self._base
+
+    def _grow(self):
+        self._limit = min(self._maximum, self._limit + self._increase / self._limit)
+        self._wake()
+
+    def _backoff(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(self._minimum, self._limit * self._decrease)
+        # 新しいlimitを基準にやり直す
+        self._fast_latency = self._base
+        self._over_threshold = 0
+
+
+class TokenBudget:
+    """Global budget of estimated in-flight tokens (prompt + expected completion).
+
+    Reservations are granted in FIFO order so a large record at the head of the
+    line is not starved by a stream of small ones. A single reservation larger
+    than the whole budget is clamped to it, i.e. it runs alone.
+    """
+
+    def __init__(self, budget: int):
+        self._budget = max(1, budget)
+        self._in_flight = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self, cost: int) -> int:
+        cost = min(max(1, cost), self._budget)
+        if not self._waiters and self._in_flight + cost <= self._budget:
+            self._in_flight += cost
+            return cost
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((cost, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(cost)
+            else:
+                self._wake()
+            raise
+        return cost
+
+    def release(self, cost: int):
+        self._in_flight -= cost
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            cost, fut = self._waiters[0]
+            if fut.done():
+                self._waiters.popleft()
+                continue
+            if self._in_flight + cost > self._budget:
+                return
+            self._waiters.popleft()
+            self._in_flight += cost
+            fut.set_result(True)
+
+    @asynccontextmanager
+    async def reserve(self, cost: int):
+        granted = await self.acquire(cost)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
@@ -1,21 +1,138 @@
 import argparse
 import asyncio
 import importlib.util
+import itertools
 from asyncio import Semaphore
 from importlib.machinery import ModuleSpec
 from os import path
 from os.path import dirname
 
 import tqdm
+from datasets import Dataset, IterableDataset
 
+import cache
+import circuit
+import client
+import fanout
+import metrics
+import profiler
+import prompt
+import retry
+import rubric_fields
+import streaming
+import tracing
+import usage
 from core import InferenceTask
+from dedup import deduplicator, report
+from database import ResultWriter
+from ingest import Prefetcher, StreamCheckpoints, split_size, stream_items
+from limiter import AdaptiveSemaphore, TokenBudget
+from ordering import CostModel, longest_first
+from preprocess import Preparer, has_prepare
+from resume import ResumeIndex, pending_items
+from scheduler import Scheduler
+from sharding import Shard, find_shards, merge_shards, prepare_shard_db
 
 
 async def main():
     parser = argparse.ArgumentParser(description="Run dataset-parallel-inference project")
     parser.add_argument("--project", type=str, required=True, help="Project name")
     parser.add_argument("--concurrency", type=int, default=1, help="Concurrency size")
+    parser.add_argument("--concurrency-mode", choices=["fixed", "adaptive"], default="fixed",
+                        help="fixed: use --concurrency as is, "
+                             "adaptive: start at --concurrency and adjust with AIMD up to --max-concurrency")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Upper bound for the adaptive mode (default: 4x --concurrency)")
+    parser.add_argument("--token-budget", type=int, default=None,
+                        help="Admit records only while their estimated prompt + completion tokens "
+                             "fit in this global in-flight budget")
+    parser.add_argument("--order", choices=["dataset", "longest-first"], default="dataset",
+                        help="dataset: process rows in dataset order, "
+                             "longest-first: process rows with the largest predicted cost first")
+    parser.add_argument("--record-fanout", type=int, default=1,
+                        help="Independent requests of one record (example_3_* rubrics, rubric fields with "
+                             "--concurrent-fields) run at the same time at most, each extra one on a free "
+                             "--concurrency slot (1 runs them one after another)")
+    parser.add_argument("--concurrent-fields", action="store_true",
+                        help="rubric_if_translate_field*: translate the rubric fields with only the translated prompt "
+                             "as history, up to --record-fanout at a time (default: in order, each seeing the earlier "
+                             "fields)")
+    parser.add_argument("--recheck-min-chars", type=int, default=0,
+                        help="rubric_if_translate_field*: skip the re-check turn for fields shorter than this "
+                             "(0 always re-checks)")
+    parser.add_argument("--prefetch", type=int, default=256,
+                        help="Rows read ahead from the dataset in a background thread (0 reads on the event loop)")
+    parser.add_argument("--dataset-checkpoint-every", type=int, default=10000,
+                        help="With a streaming dataset, save its position every this many rows so a resumed run "
+                             "starts reading at the first pending row")
+    parser.add_argument("--prepare-workers", type=int, default=4,
+                        help="Workers running the task's prepare() ahead of dispatch (0 runs it on the event loop)")
+    parser.add_argument("--prepare-pool", choices=["thread", "process"], default="thread",
+                        help="thread: prepare() in threads, process: in processes (needs a @staticmethod prepare())")
+    parser.add_argument("--prepare-lookahead", type=int, default=256,
+                        help="Records prepared ahead of the workers at most")
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 for API requests (needs httpx[http2])")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="Connect timeout of API requests (s)")
+    parser.add_argument("--read-timeout", type=float, default=1800.0,
+                        help="Base read timeout of API requests (s), extended per request by the expected output length")
+    parser.add_argument("--min-tokens-per-second", type=float, default=10.0,
+                        help="Slowest generation speed still considered alive, used to scale per-request deadlines")
+    parser.add_argument("--endpoint-affinity", action="store_true",
+                        help="With several endpoints in BASE_URL, send every request of a record to the same one")
+    parser.add_argument("--retry-attempts", type=int, default=4,
+                        help="Attempts per API call before the call is given up")
+    parser.add_argument("--retry-budget", type=int, default=12,
+                        help="Retries one record may spend across all of its API calls")
+    parser.add_argument("--retry-max-delay", type=float, default=60.0,
+                        help="Upper bound of the backoff between attempts (s)")
+    parser.add_argument("--breaker-threshold", type=int, default=8,
+                        help="Different calls failing in a row with connection/gateway errors that pause all "
+                             "dispatch until the backend answers again (at most --concurrency, 0 disables)")
+    parser.add_argument("--breaker-probe-interval", type=float, default=5.0,
+                        help="Interval of the health probe while dispatch is paused (s)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream completions (projects that support it) and cancel them early on a repetition "
+                             "loop, runaway length or a stall, retrying the request")
+    parser.add_argument("--stream-stall-timeout", type=float, default=60.0,
+                        help="Cancel a streamed completion when no chunk arrives for this long (s)")
+    parser.add_argument("--stream-max-ratio", type=float, default=4.0,
+                        help="Cancel a streamed completion whose output exceeds this many times the expected length "
+                             "(0 disables)")
+    parser.add_argument("--cache", type=str, default=None, metavar="PATH",
+                        help="Cache chat completion responses in this sqlite file and answer repeated requests from it")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Size of the response cache before LRU eviction")
+    parser.add_argument("--cache-deterministic-only", action="store_true",
+                        help="Cache only requests sent with temperature 0")
+    parser.add_argument("--cache-warm", action="store_true",
+                        help="Before the run, store the requests behind results already in the task's DB in the cache")
+    parser.add_argument("--prompt-layout", choices=prompt.LAYOUTS, default="legacy",
+                        help="prefix-stable: order prompt segments from most to least stable "
+                             "(system, instructions, record, history, current unit) for the server's prefix cache")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Translate each text repeated across the pending records once and share the result")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="i/n: process only shard i of n and write the results to a shard DB next to the task's DB")
+    parser.add_argument("--shard-mode", choices=["contiguous", "strided"], default="contiguous",
+                        help="contiguous: shard i gets the i-th block of rows, strided: rows with order %% n == i")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="Merge the shard DBs of the project into its DB, report missing rows and exit")
+    parser.add_argument("--trace", type=str, default=None, metavar="PATH",
+                        help="Append a JSONL trace of every API call, retry, record and DB write to this file "
+                             "(summarize it with trace_report.py)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve live run metrics in the Prometheus text format on this port (GET /metrics)")
+    parser.add_argument("--metrics-host", type=str, default="127.0.0.1", help="Address of the metrics endpoint")
+    parser.add_argument("--profile", type=str, default=None, metavar="PATH",
+                        help="Sample the event loop's stack and write folded stacks (flamegraph.pl / speedscope) "
+                             "to this file, printing the top functions and coroutines by CPU time at exit")
+    parser.add_argument("--profile-start", type=float, default=0.0,
+                        help="Start sampling this many seconds after the run starts (s)")
+    parser.add_argument("--profile-duration", type=float, default=None,
+                        help="Stop sampling after this many seconds (default: until the run ends)")
+    parser.add_argument("--profile-interval-ms", type=float, default=5.0, help="Sampling interval (ms)")
+    parser.add_argument("--profile-top", type=int, default=30, help="Number of functions listed in the summary")
     args = parser.parse_args()
+    shard = Shard.parse(args.shard, strided=args.shard_mode == "strided") if args.shard is not None else None
 
     task_path = path.join(dirname(__file__), "projects", args.project, "task.py")
     if not path.exists(task_path):
@@ -24,16 +141,181 @@ async def main():
     spec: ModuleSpec = importlib.util.spec_from_file_location("task", task_path)
     module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(module)  # pyright: ignore[reportOptionalMemberAccess]
+    if args.concurrency_mode == "adaptive":
+        max_concurrency = args.max_concurrency or args.concurrency * 4
+        semaphore = AdaptiveSemaphore(initial=args.concurrency, maximum=max_concurrency)
+    else:
+        max_concurrency = args.concurrency
+        semaphore = Semaphore(value=args.concurrency)
+    # タスクのコンストラクタで作られるクライアントの接続プールを同時実行数に合わせる
+    client.configure(pool_size=max_concurrency, http2=args.http2, connect_timeout=args.connect_timeout,
+                     read_timeout=args.read_timeout, min_tokens_per_second=args.min_tokens_per_second,
+                     affinity=args.endpoint_affinity)
+    retry.configure(max_attempts=args.retry_attempts, record_retries=args.retry_budget,
+                    max_delay=args.retry_max_delay)
+    prompt.configure(args.prompt_layout)
+    cache.configure(args.cache, max_bytes=args.cache_max_mb << 20, deterministic_only=args.cache_deterministic_only)
+    # 同時に失敗できる呼び出しは同時実行数までなので、それを超える閾値には届かない
+    circuit.configure(threshold=min(args.breaker_threshold, args.concurrency),
+                      probe_interval=args.breaker_probe_interval)
+    tracing.configure(args.trace, project=args.project)
+    profiler.configure(args.profile, start_after=args.profile_start, duration=args.profile_duration,
+                       interval=args.profile_interval_ms / 1000, top=args.profile_top)
+    streaming.configure(args.stream, stall_timeout=args.stream_stall_timeout, max_ratio=args.stream_max_ratio)
+    fanout.configure(args.record_fanout)
+    rubric_fields.configure(args.concurrent_fields, recheck_min_chars=args.recheck_min_chars)
     task: InferenceTask = module.Task()
-    semaphore = Semaphore(value=args.concurrency)
-    bar = tqdm.tqdm(total=task.get_length())
-    task_queue = set()
-    for (order, item) in enumerate(iter(task.dataset)):
-        task_queue.add(asyncio.create_task(task.process(item, order, semaphore, bar)))
-        if task_queue.__len__() > args.concurrency * 2:
-            while task_queue.__len__() > args.concurrency * 1.5:
-                _, task_queue = await asyncio.wait(task_queue, timeout=3)
-    await asyncio.wait(task_queue)
+    # streaming=True のデータセットは分割のメタデータから件数を取る
+    total = split_size(task.dataset) if isinstance(task.dataset, IterableDataset) else None
+    if total is None:
+        total = task.get_length()
+    size = len(task.dataset) if isinstance(task.dataset, (list, range)) else total
+    if args.merge_shards:
+        merge_project_shards(task, size)
+        return
+    if args.cache_warm:
+        if args.cache is None:
+            raise ValueError("--cache-warm needs --cache")
+        print(f"response cache: warmed {await task.warm_cache()} request(s) from stored results")
+    # 完了済みの行はタスク化する前に除外する
+    resume_index = ResumeIndex.load(task, size)
+    completed = resume_index.completed
+    if shard is not None and task.db_path is not None:
+        shard_db = shard.db_path(task.db_path)
+        prepare_shard_db(task.db_path, shard_db)
+        # 以降の書き込み・レジューム判定はシャードDBに対して行う
+        task.db_path = shard_db
+        for order in task.completed_orders():
+            resume_index.add(order)
+        shard_orders = shard.orders(size)
+        completed = sum(1 for order in shard_orders if order in resume_index)
+        total = len(shard_orders)
+        # 他のシャードの行は完了扱いにしてスケジュールしない
+        for order in range(size):
+            if order not in shard_orders:
+                resume_index.add(order)
+        print(f"shard {shard.index}/{shard.count}: {total} rows, writing to {shard_db}")
+    elif shard is not None:
+        print("--shard needs a task with db_path, processing every row")
+        shard = None
+    if args.dedup:
+        # 実行前に全レコードを一巡して重複を数える
+        print(report(deduplicator.scan(task, pending_items(task.dataset, resume_index, shard))))
+    bar = tqdm.tqdm(total=total, initial=completed)
+    writer = ResultWriter(task.db_path) if task.db_path is not None else None
+    usage_table = f"{task.result_table}_usage" if writer is not None and task.result_table is not None else None
+    if usage_table is not None:
+        usage.create_table(task.db_path, usage_table)
+    if writer is not None:
+        await writer.start()
+    budget = TokenBudget(args.token_budget) if args.token_budget is not None else None
+    preparer = None
+    if args.prepare_workers > 0 and has_prepare(task):
+        preparer = Preparer(task, task_path, workers=args.prepare_workers, pool=args.prepare_pool,
+                            lookahead=args.prepare_lookahead)
+    scheduler = Scheduler(task, semaphore, bar, workers=max_concurrency, writer=writer, budget=budget,
+                          usage_table=usage_table, preparer=preparer)
+    if args.order == "longest-first" and isinstance(task.dataset, (Dataset, list, range)):
+        items = longest_first(task.dataset, resume_index, CostModel(task.observed_lengths()), shard)
+    else:
+        if args.order == "longest-first":
+            print("--order longest-first needs a random-access dataset, falling back to dataset order")
+        if isinstance(task.dataset, IterableDataset):
+            checkpoints = None
+            if task.db_path is not None:
+                checkpoints = StreamCheckpoints(f"{task.db_path}.stream.json", every=args.dataset_checkpoint_every)
+            items = stream_items(task.dataset, resume_index, checkpoints)
+        else:
+            items = pending_items(task.dataset, resume_index, shard)
+    if args.prefetch > 0 and not isinstance(task.dataset, (list, range)):
+        # ダウンロード・デコードをイベントループの外で先読みする
+        items = Prefetcher(items, args.prefetch)
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = await serve_metrics(args.metrics_host, args.metrics_port, scheduler, writer, semaphore)
+    throughput = asyncio.create_task(show_throughput(bar, scheduler))
+    tracing.start()
+    profiler.start()
+    try:
+        await scheduler.run(items)
+        if args.dedup:
+            print(f"dedup: {deduplicator.shared} call(s) answered by a shared result")
+        print(usage.stats.summary())
+        if streaming.summary() is not None:
+            print(streaming.summary())
+    finally:
+        throughput.cancel()
+        profiler.stop()
+        if preparer is not None:
+            preparer.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        try:
+            if writer is not None:
+                # 書き込みに失敗していた場合はここで WriterError になる
+                await writer.close()
+        finally:
+            await cache.close()
+            await tracing.close()
+
+
+async def serve_metrics(host: str, port: int, scheduler: Scheduler, writer: ResultWriter | None,
+                        semaphore: Semaphore) -> asyncio.Server:
+    """Register the metrics read from this run's objects and start the endpoint."""
+    meter = usage.Throughput()
+    metrics.register(metrics.Gauge("inference_queue_depth", "Records read from the dataset and waiting for a worker",
+                                   collect=lambda: scheduler.queue_depth))
+    metrics.register(metrics.Counter("inference_tokens_total", "Tokens reported in API usage, by kind", ("kind",),
+                                     collect=lambda: {("prompt",): usage.stats.prompt_tokens,
+                                                      ("cached",): usage.stats.cached_tokens,
+                                                      ("completion",): usage.stats.completion_tokens,
+                                                      ("reasoning",): usage.stats.reasoning_tokens}))
+    metrics.register(metrics.Gauge("inference_generation_tokens_per_second",
+                                   "Completion tokens per second over the scrapes of the last 30 s",
+                                   collect=meter.rate))
+    metrics.register(metrics.Gauge("inference_backend_up", "0 while the circuit breaker pauses dispatch",
+                                   collect=lambda: 0.0 if circuit.breaker.is_open else 1.0))
+    metrics.register(metrics.Gauge("inference_endpoint_up", "0 while a balanced endpoint is ejected", ("endpoint",),
+                                   collect=client.endpoint_health))
+    if isinstance(semaphore, AdaptiveSemaphore):
+        metrics.register(metrics.Gauge("inference_concurrency_limit", "Current limit of --concurrency-mode adaptive",
+                                       collect=lambda: semaphore.limit))
+    if writer is not None:
+        metrics.register(metrics.Gauge("inference_writer_pending_rows", "Result rows waiting for the DB writer",
+                                       collect=lambda: writer.pending))
+        metrics.register(metrics.Counter("inference_writer_rows_total", "Result rows committed by the DB writer",
+                                         collect=lambda: writer.written))
+    server = await metrics.serve(host, port)
+    print(f"metrics: serving http://{host}:{port}/metrics")
+    return server
+
+
+async def show_throughput(bar: tqdm.tqdm, scheduler: Scheduler, interval: float = 1.0):
+    """Keep the generated tokens/s of the last 30 s in the progress bar."""
+    meter = usage.Throughput()
+    while True:
+        await asyncio.sleep(interval)
+        postfix = {"tok/s": f"{meter.rate():.0f}"}
+        if scheduler.failed:
+            postfix["failed"] = len(scheduler.failed)
+        bar.set_postfix(postfix)
+
+
+def merge_project_shards(task: InferenceTask, size: int):
+    if task.db_path is None:
+        raise ValueError("--merge-shards needs a task with db_path")
+    shard_paths = find_shards(task.db_path)
+    merged = merge_shards(task.db_path, shard_paths)
+    print(f"merged {len(shard_paths)} shard(s) into {task.db_path}: "
+          + ", ".join(f"{table}={count}" for table, count in merged.items()))
+    # レジュームと同じ判定で網羅性を確認する
+    index = ResumeIndex.load(task, size)
+    missing = size - index.completed
+    if missing:
+        first = list(itertools.islice((order for pending in index.pending_ranges() for order in pending), 20))
+        print(f"{missing} of {size} row(s) have no result, e.g. orders {first}")
+        raise SystemExit(1)
+    print(f"all {size} row(s) are covered")
 
 
 if __name__ == "__main__":
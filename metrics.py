@@ -0,0 +1,217 @@
+import asyncio
+import math
+import time
+from typing import Callable, Iterable
+
+import httpx
+
+# ラベル値の組 -> 値
+Samples = dict[tuple[str, ...], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """One metric family in the Prometheus text format.
+
+    Values are either updated in place (``inc`` / ``set``) or read at scrape time
+    from ``collect``, which returns the samples keyed by label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                 collect: Callable[[], Samples | float] | None = None):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._collect = collect
+        self._values: Samples = {}
+
+    def samples(self) -> Samples:
+        if self._collect is None:
+            return self._values
+        collected = self._collect()
+        return collected if isinstance(collected, dict) else {(): collected}
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, value in sorted(self.samples().items()):
+            yield f"{self.name}{_labels(self.labelnames, values)} {_number(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labelvalues: str):
+        self._values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1.0):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self._counts[index] += 1
+                break
+        self._sum += value
+        self._count += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{_number(bound)}"}} {cumulative}'
+        yield f"{self.name}_sum {_number(self._sum)}"
+        yield f"{self.name}_count {self._count}"
+
+
+_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# 各モジュールが直接更新するもの
+requests_in_flight = Gauge("inference_requests_in_flight", "API requests sent and not yet finished", ("endpoint",))
+request_errors = Counter("inference_request_errors_total",
+                         "API requests that failed to connect or returned an error status", ("endpoint", "error"))
+request_duration = Histogram("inference_request_duration_seconds",
+                             "Wall time of API requests until the response body is closed", _LATENCY_BUCKETS)
+time_to_first_token = Histogram("inference_time_to_first_token_seconds",
+                                "Time to the first chunk of streamed completions (--stream)", _LATENCY_BUCKETS)
+records = Counter("inference_records_total",
+                  "Records finished: completed (row stored), skipped (no row returned) or failed (raised)",
+                  ("status",))
+retries = Counter("inference_retries_total", "API calls retried by call_with_retry, by error class", ("error",))
+stream_aborts = Counter("inference_stream_aborts_total", "Streamed completions cancelled early, by reason",
+                        ("reason",))
+
+_registry: list[Metric] = [requests_in_flight, request_errors, request_duration, time_to_first_token, records,
+                           retries, stream_aborts]
+
+
+def register(metric: Metric) -> Metric:
+    """Add a metric (usually a ``collect`` one bound to run-time objects by main.py) to the endpoint."""
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+def _endpoint(request: httpx.Request) -> str:
+    return f"{request.url.scheme}://{request.url.netloc.decode('ascii')}"
+
+
+class _ObservedStream(httpx.AsyncByteStream):
+    """Response body that ends the request's in-flight span when closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, done: Callable[[], None]):
+        self._stream = stream
+        self._done = done
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if self._done is not None:
+            self._done()
+            self._done = None
+        await self._stream.aclose()
+
+
+class MetricsTransport(httpx.AsyncBaseTransport):
+    """Counts in-flight requests and errors per endpoint and times every request."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = _endpoint(request)
+        start = time.monotonic()
+        requests_in_flight.inc(endpoint)
+
+        def done():
+            requests_in_flight.dec(endpoint)
+            request_duration.observe(time.monotonic() - start)
+
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException as e:
+            done()
+            request_errors.inc(endpoint, type(e).__name__)
+            raise
+        if response.status_code >= 400:
+            request_errors.inc(endpoint, str(response.status_code))
+        response.stream = _ObservedStream(response.stream, done)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def wrap(transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    return MetricsTransport(transport)
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # ヘッダーは読み捨てる
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.Server:
+    """Serve ``GET /metrics`` in the Prometheus text format on the running event loop."""
+    return await asyncio.start_server(_handle, host, port)
@@ -0,0 +1,95 @@
+import json
+from array import array
+from bisect import bisect_right
+from typing import Any, Iterable, Iterator
+
+from datasets import Dataset
+
+from resume import ResumeIndex, pending_items
+from sharding import Shard
+
+# dataset_statistics.py の Length Distribution と同じ区切り
+LENGTH_BUCKETS = [1000, 2500, 5000, 10000, 20000, 50000]
+
+
+def calculate_prompt_length(data: dict) -> int:
+    """
+    Calculate the length of input_json_str as done in task.py process() method.
+    This replicates the exact logic used in the actual processing.
+    """
+    try:
+        # "extra_info" は dict型
+        if "extra_info" in data and data["extra_info"] is not None:
+            input_json_str = json.dumps(data["extra_info"], ensure_ascii=False, separators=(",", ":"))
+        else:
+            raise KeyError("extra_info")
+    except (KeyError, ValueError, TypeError):
+        # "extra_info" が存在しないかデコードできない場合は他のキーを試行
+        prompt = data.get("prompt") or data.get("query")
+        reward_model = data.get("reward_model")
+        rubrics = data.get("Rubrics") or data.get("rubrics")
+        
+        if prompt is not None:
+            # 取得できたキーで構成する
+            obj = {"prompt": prompt}
+            if reward_model is not None:
+                obj["reward_model"] = reward_model
+            if rubrics is not None:
+                obj["rubrics"] = rubrics
+            
+            input_json_str = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        else:
+            # 何も取得できない場合はデータ全体をダンプ（フォールバック）
+            try:
+                input_json_str = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+            except (ValueError, TypeError):
+                input_json_str = ""
+    
+    return len(input_json_str)
+
+
+
+class CostModel:
+    """Predicts the cost of a record as input length plus expected completion length.
+
+    The completion/input ratio is learned per input length bucket from
+    ``(input_length, output_length)`` pairs of results already stored in the DB,
+    falling back to the overall ratio and then to 1.0.
+    """
+
+    def __init__(self, observed: Iterable[tuple[int, int]] = ()):
+        inputs = [0] * (len(LENGTH_BUCKETS) + 1)
+        outputs = [0] * (len(LENGTH_BUCKETS) + 1)
+        for input_length, output_length in observed:
+            if not input_length or output_length is None:
+                continue
+            bucket = bisect_right(LENGTH_BUCKETS, input_length)
+            inputs[bucket] += input_length
+            outputs[bucket] += output_length
+        overall = sum(outputs) / sum(inputs) if sum(inputs) else 1.0
+        self.ratios = [output / input if input else overall for input, output in zip(inputs, outputs)]
+
+    def predict(self, input_length: int) -> float:
+        return input_length * (1.0 + self.ratios[bisect_right(LENGTH_BUCKETS, input_length)])
+
+
+def record_length(data: Any) -> int:
+    if isinstance(data, dict):
+        return calculate_prompt_length(data)
+    return len(str(data))
+
+
+def longest_first(dataset: Dataset | list | range, index: ResumeIndex, cost_model: CostModel,
+                  shard: Shard | None = None) -> Iterator[tuple[int, Any]]:
+    """Pending (order, item) pairs sorted by predicted cost, most expensive first (LPT).
+
+    Orders are kept as they are, so results and resume still use the dataset position.
+    """
+    orders = array("q")
+    costs = array("d")
+    for order, item in pending_items(dataset, index, shard):
+        orders.append(order)
+        costs.append(cost_model.predict(record_length(item)))
+    for position in sorted(range(len(orders)), key=costs.__getitem__, reverse=True):
+        order = orders[position]
+        yield order, dataset[order]
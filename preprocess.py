@@ -0,0 +1,72 @@
+import asyncio
+import importlib.util
+import inspect
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from core import InferenceTask
+
+# プロセスプールの各ワーカーで読み込んだタスクのクラス
+_task_class: type[InferenceTask] | None = None
+
+
+def _load_task_class(task_path: str):
+    global _task_class
+    spec = importlib.util.spec_from_file_location("task", task_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # pyright: ignore[reportOptionalMemberAccess]
+    _task_class = module.Task
+
+
+def _prepare_in_process(item: Any) -> Any:
+    return _task_class.prepare(item)  # pyright: ignore[reportOptionalMemberAccess]
+
+
+def has_prepare(task: InferenceTask) -> bool:
+    return type(task).prepare is not InferenceTask.prepare
+
+
+class Preparer:
+    """Runs ``InferenceTask.prepare()`` in a worker pool ahead of dispatch.
+
+    The scheduler submits a record when it reads it from the dataset and the
+    worker that picks the record awaits the result before ``process()``, so
+    the event loop only sees ready-to-send payloads. At most ``lookahead``
+    records are being prepared or waiting for a worker at once.
+
+    The process pool loads the task module in every worker and calls
+    ``Task.prepare(item)`` on the class, so it needs ``prepare`` to be a
+    ``@staticmethod``; records and results are pickled across processes.
+    """
+
+    def __init__(self, task: InferenceTask, task_path: str, workers: int = 4, pool: str = "thread",
+                 lookahead: int = 256):
+        self._slots = asyncio.Semaphore(max(1, lookahead))
+        if pool == "process" and not isinstance(inspect.getattr_static(type(task), "prepare"), staticmethod):
+            print("--prepare-pool process needs prepare() to be a @staticmethod, using threads")
+            pool = "thread"
+        self._executor: Executor
+        self._prepare: Callable[[Any], Any]
+        if pool == "process":
+            # fork はスレッド (prefetch, writer) を持つプロセスでは安全でない
+            self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_load_task_class, initargs=(task_path,))
+            self._prepare = _prepare_in_process
+        else:
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix="prepare")
+            self._prepare = task.prepare
+
+    async def submit(self, item: Any) -> asyncio.Future:
+        """Start preparing ``item``; waits while ``lookahead`` records are already ahead of the workers."""
+        await self._slots.acquire()
+        return asyncio.get_running_loop().run_in_executor(self._executor, self._prepare, item)
+
+    async def result(self, future: asyncio.Future) -> Any:
+        try:
+            return await future
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
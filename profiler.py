@@ -0,0 +1,207 @@
+import asyncio
+import os
+import signal
+import time
+from collections import Counter
+from types import CodeType, FrameType
+
+# 呼び出し元を含む時間を集計する関数 (ラベル, ファイル名の末尾, 関数名)。関数名 None はファイル内の全関数
+HOT_SPOTS = [
+    ("json.dumps", os.path.join("json", "__init__.py"), "dumps"),
+    ("json.loads", os.path.join("json", "__init__.py"), "loads"),
+    ("pydantic model_dump", os.path.join("pydantic", "main.py"), "model_dump"),
+    ("pydantic model_validate_json", os.path.join("pydantic", "main.py"), "model_validate_json"),
+    ("jsonpath_ng.parse", os.path.join("jsonpath_ng", "parser.py"), None),
+    ("prompt building (prompt.py)", os.sep + "prompt.py", None),
+    ("prompt building (_history)", "task.py", "_history"),
+    ("prompt building (_messages)", "task.py", "_messages"),
+]
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Sampler:
+    """Samples the stack of the event-loop thread on a CPU-time timer.
+
+    ``SIGPROF`` fires every ``interval`` seconds of process CPU time and its
+    handler runs on the loop thread between two bytecodes, so the sample is
+    taken where the loop is actually executing rather than where it happens to
+    release the GIL. The loop thread's CPU time used since the previous sample
+    is charged to the current stack and to the coroutine of the running asyncio
+    task; time spent waiting in ``select`` costs no CPU and adds nothing.
+    Must be started from the main thread (signal handlers run there).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.005, start_after: float = 0.0,
+                 duration: float | None = None):
+        self._loop = loop
+        self._interval = interval
+        self._start_after = start_after
+        self._duration = duration
+        self._labels: dict[CodeType, str] = {}
+        self._handles: list[asyncio.TimerHandle] = []
+        self._previous_handler = None
+        self._armed_at: float | None = None
+        self._last_cpu = 0.0
+        # 折りたたみスタック -> CPU秒
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.coroutines: Counter[str] = Counter()
+        self.samples = 0
+        self.cpu = 0.0
+        self.wall = 0.0
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if filename.startswith(_ROOT + os.sep):
+                filename = os.path.relpath(filename, _ROOT)
+            else:
+                filename = os.sep.join(filename.split(os.sep)[-2:])
+            name = getattr(code, "co_qualname", code.co_name)
+            # ";" は折りたたみ形式の区切り文字
+            label = f"{name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+            self._labels[code] = label
+        return label
+
+    def _coroutine(self) -> str:
+        task = asyncio.current_task(self._loop)
+        if task is None:
+            return "(event loop)"
+        coro = task.get_coro()
+        return getattr(coro, "__qualname__", None) or task.get_name()
+
+    def _stack(self, frame: FrameType | None) -> tuple[str, ...]:
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def _sample(self, _signum: int, frame: FrameType | None):
+        cpu = time.thread_time()
+        used, self._last_cpu = cpu - self._last_cpu, cpu
+        if used > 0 and frame is not None:
+            self.stacks[self._stack(frame)] += used
+            self.coroutines[self._coroutine()] += used
+            self.samples += 1
+            self.cpu += used
+
+    def _arm(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        # 他スレッドのシステムコールを EINTR で中断しない
+        signal.siginterrupt(signal.SIGPROF, False)
+        self._last_cpu = time.thread_time()
+        self._armed_at = time.monotonic()
+        signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+        if self._duration is not None:
+            self._handles.append(self._loop.call_later(self._duration, self._disarm))
+
+    def _disarm(self):
+        if self._armed_at is None:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.wall += time.monotonic() - self._armed_at
+        self._armed_at = None
+
+    def start(self):
+        if self._start_after > 0:
+            self._handles.append(self._loop.call_later(self._start_after, self._arm))
+        else:
+            self._arm()
+
+    def stop(self):
+        for handle in self._handles:
+            handle.cancel()
+        self._disarm()
+
+    def write_folded(self, path: str):
+        """Folded stacks (``frame;frame;frame microseconds``) for flamegraph.pl, speedscope or inferno."""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, cpu in self.stacks.most_common():
+                weight = round(cpu * 1e6)
+                if weight > 0:
+                    f.write(f"{';'.join(stack)} {weight}\n")
+
+    def summary(self, top: int = 30) -> str:
+        if self.cpu <= 0:
+            return "profile: no CPU time sampled on the event loop"
+        self_time: Counter[str] = Counter()
+        total_time: Counter[str] = Counter()
+        for stack, cpu in self.stacks.items():
+            self_time[stack[-1]] += cpu
+            # 再帰しても1スタックにつき1回だけ数える
+            for label in set(stack):
+                total_time[label] += cpu
+        busy = self.cpu / self.wall if self.wall > 0 else 0.0
+        lines = [f"profile: {self.cpu:.1f}s CPU on the event loop in {self.wall:.0f}s ({busy:.0%} busy), "
+                 f"{self.samples:,} samples"]
+
+        def table(title: str, counter: Counter[str], limit: int):
+            lines.append(f"\n{title}:")
+            lines.append(f"  {'CPU s':>9} {'share':>7}  name")
+            for name, cpu in counter.most_common(limit):
+                lines.append(f"  {cpu:>9.2f} {cpu / self.cpu:>7.1%}  {name}")
+
+        table("Coroutines", self.coroutines, top)
+        table(f"Top {top} functions by self time", self_time, top)
+        table(f"Top {top} functions by total time", total_time, top)
+        hot: Counter[str] = Counter()
+        for stack, cpu in self.stacks.items():
+            for label, file_suffix, function in HOT_SPOTS:
+                if any(_matches(frame, file_suffix, function) for frame in stack):
+                    hot[label] += cpu
+        table("Suspected hot spots (total time)", Counter({label: hot[label] for label, _, _ in HOT_SPOTS}),
+              len(HOT_SPOTS))
+        return "\n".join(lines)
+
+
+def _matches(label: str, file_suffix: str, function: str | None) -> bool:
+    name, _, location = label.rpartition(" (")
+    filename = location.rsplit(":", 1)[0]
+    if not filename.endswith(file_suffix) and not (os.sep + filename).endswith(file_suffix):
+        return False
+    return function is None or name == function or name.endswith("." + function)
+
+
+# main.py の configure() で設定される
+_path: str | None = None
+_start_after = 0.0
+_duration: float | None = None
+_interval = 0.005
+_top = 30
+_sampler: Sampler | None = None
+
+
+def configure(path: str | None, start_after: float = 0.0, duration: float | None = None,
+              interval: float = 0.005, top: int = 30):
+    """Enable the sampling profiler (``None`` disables it). The folded stacks are written to ``path``."""
+    global _path, _start_after, _duration, _interval, _top
+    _path = path
+    _start_after = start_after
+    _duration = duration
+    _interval = interval
+    _top = top
+
+
+def start():
+    """Start sampling the running event loop. Call from inside the loop, on the main thread."""
+    global _sampler
+    if _path is None:
+        return
+    _sampler = Sampler(asyncio.get_running_loop(), interval=_interval, start_after=_start_after,
+                       duration=_duration)
+    _sampler.start()
+
+
+def stop():
+    """Stop sampling, write the folded stacks and print the top-N summary."""
+    global _sampler
+    if _sampler is None:
+        return
+    _sampler.stop()
+    _sampler.write_folded(_path)
+    print(_sampler.summary(_top))
+    print(f"profile: folded stacks written to {_path}")
+    _sampler = None
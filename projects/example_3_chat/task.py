@@ -2,17 +2,24 @@ import json
 import os
 import sqlite3
 import asyncio
+from functools import partial
 from os import path
 from os.path import dirname
 from typing import Any
 import tqdm
 from datasets import load_dataset
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError, Omit
+from openai import OpenAIError, Omit
 from openai.types.chat import ChatCompletionSystemMessageParam, ChatCompletionUserMessageParam, ChatCompletionAssistantMessageParam
 from pydantic import BaseModel
 
-from core import InferenceTask
+from circuit import is_outage_error
+from client import create_client, request_timeout
+from core import InferenceTask, ResultRow
+import fanout
+import tracing
+from retry import call_with_retry
+from streaming import chat_completion
 from asyncio import Semaphore
 
 from projects.example_3_chat.model import RootModel, Prompt, Rubric
@@ -20,16 +27,17 @@ from projects.example_3_chat.model import RootModel, Prompt, Rubric
 
 class Task(InferenceTask):
     def __init__(self):
-        self._db = sqlite3.connect(path.join(dirname(__file__), "db.sqlite"))
+        self.db_path = path.join(dirname(__file__), "db.sqlite")
+        self._db = sqlite3.connect(self.db_path)
+        self.result_table = "result"
         self._cur = self._db.cursor()
-        self._db_write_sem = Semaphore(value=1)
         self.dataset = load_dataset("NovelHacja/RubricHub_v1_config", "chat", split="train", streaming=False)
         self._cur.execute(f"CREATE TABLE IF NOT EXISTS result(id INT PRIMARY KEY,content TEXT,source TEXT,reasoning TEXT);")
         self._replace_keys = ["prompt", "reward_model", "Rubrics:reward_model.rubrics"]
         self._long_str_threshold = 2500
         self._extremely_long_prompt_threshold = 16384
         load_dotenv(path.join(dirname(__file__), ".env"))
-        self._client = AsyncOpenAI(api_key=os.environ["API_KEY"], base_url=os.environ["BASE_URL"], timeout=None)
+        self._client = create_client()
         self._temperature_planning = 0.7
         self._temperature_execution = 0.5
         self._full_chat_planning_strings = [
@@ -241,13 +249,14 @@ class Task(InferenceTask):
         self._cur.close()
         self._db.close()
         
-    async def _process_prompt(self, data, order: int, chat_string_list: list[list[dict[str, Any]]], chat_string_format: dict[str, Any], replace_keys: list[str] | None = ["prompt", "reward_model", "Rubrics:reward_model.rubrics"]):
+    async def _process_prompt(self, data, order: int, sem: Semaphore, chat_string_list: list[list[dict[str, Any]]], chat_string_format: dict[str, Any], replace_keys: list[str] | None = ["prompt", "reward_model", "Rubrics:reward_model.rubrics"]):
         original_obj = data.copy()
         translated_obj = None
         reasoning_texts = []
 
         if original_obj != None:
-            sleep_time = 2.0
+            # 最終ターンでは入力JSONと同程度の長さのJSONが出力される
+            expected_output_length = sum(len(str(value)) for value in chat_string_format.values())
             max_parse_error_count = 3
             retry_count_by_parse_error = 0
             break_due_to_parse_error = False
@@ -274,16 +283,19 @@ class Task(InferenceTask):
                         # print(f"order[{order}]: turn[{turn_index}]")
                         
                         completion_type = "create" if chat_string_dict['response_format'] == None else "parse"
-                        completion_method = self._client.chat.completions.create if completion_type == "create" else self._client.chat.completions.parse
-                        resp = await completion_method(
-                            messages=prompt_cache + prompt,
-                            response_format=chat_string_dict['response_format'],    # type: ignore
-                            model=os.environ["MODEL_NAME"],
-                            temperature=chat_string_dict['temperature'],
-                            extra_body={"separate_reasoning": True},
-                            reasoning_effort=chat_string_dict['reasoning_effort'],
-                            max_tokens=131072
-                        )
+                        # --stream では出力の暴走を検知した時点で打ち切って再試行する
+                        with tracing.fields(turn=turn_index, variant=chat_str_index):
+                            resp = await call_with_retry(lambda: chat_completion(
+                                self._client, expected_output_length,
+                                messages=prompt_cache + prompt,
+                                response_format=chat_string_dict['response_format'],    # type: ignore
+                                model=os.environ["MODEL_NAME"],
+                                temperature=chat_string_dict['temperature'],
+                                extra_body={"separate_reasoning": True},
+                                reasoning_effort=chat_string_dict['reasoning_effort'],
+                                max_tokens=131072,
+                                timeout=request_timeout(expected_output_length)
+                            ), sem)
                         resp_result = resp.choices[0].message.content if chat_string_dict['response_format'] == None else resp.choices[0].message.parsed
                         if resp_result is None:
                             raise ValueError(f"Failed to get result when chat index {chat_str_index} turn {turn_index}, response is None")
@@ -344,14 +356,15 @@ class Task(InferenceTask):
                         if turn_index >= len(chat_string_list[chat_str_index]) - 1:
                             break_due_to_success = True
                     except OpenAIError as e:
-                        if sleep_time > 16.0:
-                            translated_obj = {"role": "assistant", "content": "<-- output is missing -->"}
-                            print(f"order[{order}]: OpenAI API Error: {e}, retry limit exceeded.")
-                            break
-                        print(f"order[{order}]: OpenAI API Error: {e}")
-                        await asyncio.sleep(sleep_time)
-                        sleep_time = sleep_time * 2
+                        if is_outage_error(e):
+                            # 障害中の失敗は欠損として書き込まず、レコードごと失敗させて --resume でやり直す
+                            raise
+                        # call_with_retry内で再試行済み
+                        translated_obj = {"role": "assistant", "content": "<-- output is missing -->"}
+                        print(f"order[{order}]: OpenAI API Error: {e}, retry limit exceeded.")
+                        return translated_obj, reasoning_texts
                     except (json.JSONDecodeError, KeyError, ValueError) as e:
+                        tracing.event("parse_error", turn=turn_index, variant=chat_str_index, error=type(e).__name__)
                         if retry_count_by_parse_error < max_parse_error_count * len(chat_string_list):
                             retry_count_by_parse_error += 1
                             print(f"order[{order}]: Retrying due to parse error: {e}")
@@ -368,11 +381,8 @@ class Task(InferenceTask):
                 print(f"order[{order}]: Retrying...")
         return translated_obj, reasoning_texts
 
-    async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm):
-        # id列に order の値が存在するか確認、したらスキップ
-        if self._cur.execute(f"SELECT COUNT(*) FROM result WHERE id=?;", (order,)).fetchone()[0] > 0:
-            bar.update(1)
-            return
+    @staticmethod
+    def prepare(data) -> dict[str, Any]:
         try:
             # "extra_info" は dict型
             input_json_str = json.dumps(data["extra_info"], ensure_ascii=False, separators=(",", ":"))
@@ -383,7 +393,18 @@ class Task(InferenceTask):
             except (KeyError, ValueError):
                 # "Rubrics" がデコードできないか存在しない場合は "prompts" と "reward_model" を取得
                 input_json_str = json.dumps({"prompt": data["prompt"], "reward_model": data["reward_model"]}, ensure_ascii=False, separators=(",", ":"))
-        
+        len_rubric_parameters_keys_list = [len(rubric["tags"]["parameters"].keys()) for rubric in data["Rubrics"] if "tags" in rubric and rubric["tags"]["parameters"] is not None]
+        return {
+            "data": data,
+            "input_json_str": input_json_str,
+            "max_rubric_parameters_keys": max(len_rubric_parameters_keys_list, default=0),
+        }
+
+    async def process(self, prepared, order: int, sem: Semaphore, bar: tqdm.tqdm):
+        # JSON化などは prepare() でイベントループの外で済ませてある
+        data = prepared["data"]
+        input_json_str = prepared["input_json_str"]
+
         # 極端に長いプロンプトをスキップ
         if len(input_json_str) > self._extremely_long_prompt_threshold:
             print(f"order[{order}]: Skipping extremely long prompt (length: {len(input_json_str)})")
@@ -395,12 +416,11 @@ class Task(InferenceTask):
         is_should_split = len(input_json_str) > self._long_str_threshold
         # print(f"len(data['Rubrics']): {len(data['Rubrics'])}")
         # print(f"rubrics: {[v for v in data['Rubrics']]}")
-        len_rubric_parameters_keys_list = [len(rubric["tags"]["parameters"].keys()) for rubric in data["Rubrics"] if "tags" in rubric and rubric["tags"]["parameters"] is not None]
-        is_should_split = is_should_split or (len(len_rubric_parameters_keys_list) > 0 and max(len_rubric_parameters_keys_list) > 8)
+        is_should_split = is_should_split or prepared["max_rubric_parameters_keys"] > 8
                 
         async with sem:
             if len(input_json_str) <= self._long_str_threshold:
-                translated_obj, reasoning_texts = await self._process_prompt(data, order, self._full_chat_planning_strings, {"input_json_str": input_json_str}, self._replace_keys)
+                translated_obj, reasoning_texts = await self._process_prompt(data, order, sem, self._full_chat_planning_strings, {"input_json_str": input_json_str}, self._replace_keys)
                 reasoning_text = json.dumps(reasoning_texts, ensure_ascii=False, separators=(",", ":"))
             else:
                 # long_str_threshold文字以上、またはtagsが8つ以上ついた項目がある場合はプロンプトとチャットを分離する
@@ -408,27 +428,30 @@ class Task(InferenceTask):
                 translated_obj = original_obj.copy()
                 prompt_obj = {"prompt": original_obj["prompt"]}
                 prompt_str = json.dumps(prompt_obj, ensure_ascii=False, separators=(",", ":"))
-                translated_prompt, reasoning_text_prompt = await self._process_prompt(prompt_obj, order, self._prompt_chat_planning_strings, {"prompt": prompt_str}, None)
+                translated_prompt, reasoning_text_prompt = await self._process_prompt(prompt_obj, order, sem, self._prompt_chat_planning_strings, {"prompt": prompt_str}, None)
                 translated_obj["prompt"] = translated_prompt["prompt"].copy()
                 reasoning_texts = reasoning_text_prompt
-                for idx, rubric in enumerate(original_obj["Rubrics"]):
-                    if "verifier" in rubric.keys() and rubric["verifier"] == "rule":
-                        # ruleの場合はそのまま
-                        continue
+
+                async def translate_rubric(rubric):
                     rubric_str = json.dumps(rubric, ensure_ascii=False, separators=(",", ":"))
-                    translated_rubric, reasoning_text_rubric = await self._process_prompt(rubric, order, self._criterion_chat_planning_strings, {"prompt": translated_prompt["prompt"][0]["content"], "rubric": rubric_str}, None)
+                    return await self._process_prompt(rubric, order, sem, self._criterion_chat_planning_strings, {"prompt": translated_prompt["prompt"][0]["content"], "rubric": rubric_str}, None)
+
+                # ruleの場合はそのまま
+                targets = [(idx, rubric) for idx, rubric in enumerate(original_obj["Rubrics"])
+                           if not ("verifier" in rubric.keys() and rubric["verifier"] == "rule")]
+                # --record-fanout のときは空いている枠でルーブリックを並列に翻訳する
+                rubric_results = await fanout.gather([partial(translate_rubric, rubric) for _, rubric in targets], sem)
+                for (idx, _), (translated_rubric, reasoning_text_rubric) in zip(targets, rubric_results):
                     translated_obj["Rubrics"][idx] = translated_rubric.copy()
                     reasoning_texts.extend(reasoning_text_rubric)
                 reasoning_text = json.dumps(reasoning_texts, ensure_ascii=False, separators=(",", ":"))
                 translated_obj["reward_model"]["rubrics"] = translated_obj["Rubrics"]
         
                 # print(json.dumps(translated_obj, ensure_ascii=False))
-        async with self._db_write_sem:
-            self._cur.execute(f"REPLACE INTO result(id, content, source, reasoning) VALUES (?,?,?,?);",
-                (order,
-                json.dumps(translated_obj, ensure_ascii=False),
-                json.dumps(original_obj.copy(), ensure_ascii=False),
-                reasoning_text),
-            )
-            self._db.commit()
         bar.update(1)
+        return ResultRow("result", {
+            "id": order,
+            "content": json.dumps(translated_obj, ensure_ascii=False),
+            "source": json.dumps(original_obj.copy(), ensure_ascii=False),
+            "reasoning": reasoning_text,
+        })
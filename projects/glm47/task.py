@@ -7,24 +7,26 @@ from os.path import dirname
 import tqdm
 from datasets import load_dataset
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError
-from core import InferenceTask
+from openai import OpenAIError
+from circuit import is_outage_error
+from client import create_client, request_timeout
+from core import InferenceTask, ResultRow
+from dedup import deduplicator
+from retry import call_with_retry
 from asyncio import Semaphore
 
 
 class Task(InferenceTask):
 
     def __init__(self):
-        self._db = sqlite3.connect(path.join(dirname(__file__), "db.sqlite"))
+        self.db_path = path.join(dirname(__file__), "db.sqlite")
+        self._db = sqlite3.connect(self.db_path)
+        self.result_table = "result"
         self._cur = self._db.cursor()
         self.dataset = load_dataset("nvidia/Nemotron-Instruction-Following-Chat-v1", streaming=False)["chat_if"]
         self._cur.execute('CREATE TABLE IF NOT EXISTS result(id INT PRIMARY KEY,content TEXT);')
         load_dotenv(path.join(dirname(__file__), ".env"))
-        self._client = AsyncOpenAI(
-            api_key=os.environ["API_KEY"],
-            base_url=os.environ["BASE_URL"],
-            timeout=None
-        )
+        self._client = create_client()
 
     def get_length(self) -> int:
         return self.dataset.info.splits["chat_if"].num_examples
@@ -34,11 +36,10 @@ class Task(InferenceTask):
         self._cur.close()
         self._db.close()
 
+    def translation_units(self, data) -> list[str]:
+        return [message["content"] or "" for message in data["messages"] if message["content"] != ""]
+
     async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm):
-        # id列に order の値が存在するか確認、したらスキップ
-        if self._cur.execute("SELECT COUNT(*) FROM result WHERE id=?;", (order,)).fetchone()[0] > 0:
-            bar.update(1)
-            return
         async with sem:
             input_json = data["messages"]
             output_json = [
@@ -59,31 +60,30 @@ class Task(InferenceTask):
                     output_json[-1].update(content="")
                     output_json.append({"role": "assistant", "content": ""})
                     continue
-                sleep_time = 4.0
-                while True:
-                    try:
-                        resp = await self._client.chat.completions.create(
-                            messages=output_json,
-                            model=os.environ["MODEL_NAME"],
-                            extra_body={
-                                "separate_reasoning": True
-                            },
-                            reasoning_effort="high"
-                        )
-                        output_json.append(resp.choices[0].message.to_dict())
-                        break
-                    except OpenAIError as e:
-                        if sleep_time > 16.0:
-                            output_json.append({"role": "assistant","content": ""})
-                            break
-                        print(f"OpenAI API Error: {e}")
-                        await asyncio.sleep(sleep_time)
-                        sleep_time *= 2
+
+                async def translate() -> dict:
+                    resp = await call_with_retry(lambda: self._client.chat.completions.create(
+                        messages=output_json,
+                        model=os.environ["MODEL_NAME"],
+                        extra_body={
+                            "separate_reasoning": True
+                        },
+                        reasoning_effort="high",
+                        timeout=request_timeout(len(output_json[-1]["content"] or ""))
+                    ), sem)
+                    return resp.choices[0].message.to_dict()
+
+                try:
+                    output_json.append(await deduplicator.once(output_json[-1]["content"] or "", translate, sem))
+                except OpenAIError as e:
+                    if is_outage_error(e):
+                        # 障害中の失敗は欠損として書き込まず、レコードごと失敗させて --resume でやり直す
+                        raise
+                    print(f"OpenAI API Error: {e}")
+                    output_json.append({"role": "assistant","content": ""})
             # print(json.dumps(output_json, ensure_ascii=False))
             output_json = output_json[2::2]
             for i in range(input_json.__len__()):
                 output_json[i].update(role=input_json[i]["role"])
-        self._cur.execute("REPLACE INTO result(id, content) VALUES (?,?);",
-                          (order, json.dumps(output_json, ensure_ascii=False)))
-        self._db.commit()
         bar.update(1)
+        return ResultRow("result", {"id": order, "content": json.dumps(output_json, ensure_ascii=False)})
@@ -7,21 +7,29 @@ from os.path import dirname
 import tqdm
 from datasets import load_dataset
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError
+from openai import OpenAIError
 from openai.types.chat import ChatCompletionUserMessageParam
 
-from core import InferenceTask
+from cache import completion_response, warming
+from circuit import is_outage_error
+from client import create_client, request_timeout
+from core import InferenceTask, ResultRow
+from dedup import deduplicator
+from prompt import prefix_stable, stable_messages
+from retry import call_with_retry
 from asyncio import Semaphore
 
 
 class Task(InferenceTask):
     def __init__(self):
-        self._db = sqlite3.connect(path.join(dirname(__file__), "db.sqlite"))
+        self.db_path = path.join(dirname(__file__), "db.sqlite")
+        self._db = sqlite3.connect(self.db_path)
+        self.result_table = "result"
         self._cur = self._db.cursor()
         self.dataset = load_dataset("nvidia/Nemotron-Instruction-Following-Chat-v1", streaming=False)["chat_if"]
         self._cur.execute("CREATE TABLE IF NOT EXISTS result(id INT PRIMARY KEY,content TEXT,source TEXT);")
         load_dotenv(path.join(dirname(__file__), ".env"))
-        self._client = AsyncOpenAI(api_key=os.environ["API_KEY"], base_url=os.environ["BASE_URL"], timeout=None)
+        self._client = create_client()
 
     def get_length(self) -> int:
         return self.dataset.info.splits["chat_if"].num_examples
@@ -31,11 +39,68 @@ class Task(InferenceTask):
         self._cur.close()
         self._db.close()
 
+    _instructions = "以下に外国語の文章Aが与えられます。その文章を全て日本語に翻訳してください。なお、以下の条件を**遵守**すること。\n" + \
+        "\n" + \
+        " - 人名については翻訳せず、原文での表記のまま書くこと。\n" + \
+        " - 原文に忠実に翻訳し、原文に存在する情報を欠落させたり、書かれていないことを付け加えないこと。\n" + \
+        " - 原文の雰囲気や文脈に基づいて翻訳すること。\n" + \
+        " - 翻訳済みの文章のみを出力し、余計な説明や注釈を加えないこと。\n\n"
+
+    @staticmethod
+    def _history(original_messages: list[dict], translated_messages: list[dict]) -> str:
+        return "過去の会話履歴(一貫性のある翻訳のためのコンテキスト):\n\n\n" + \
+            "\n\n\n".join(filter(None,[
+            f"===={orig['role']}=============\n" +
+            (orig['content'] or "") +
+            "\n\n-------↓↓↓↓↓↓-------\n\n" +
+            (trans['content'] or "") +
+            "\n============================="
+            if (orig["content"] or "") != "" else None for orig, trans in
+            zip(original_messages, translated_messages)
+        ]))
+
+    def _messages(self, original_messages: list[dict], translated_messages: list[dict], message: dict) -> list:
+        history = self._history(original_messages, translated_messages)
+        unit = "\n===文章A==========================\n\n\n" + str(message["content"])
+        if prefix_stable():
+            # 固定の指示をsystemに置き、履歴・対象の文章を後ろに回す
+            return stable_messages(self._instructions, unit, history=history)
+        return [
+            ChatCompletionUserMessageParam(
+                content=history + "\n\n\n\n" + self._instructions + unit,
+                role="user"
+            )]
+
+    def _translate(self, messages: list):
+        return self._client.chat.completions.create(
+            messages=messages,
+            model=os.environ["MODEL_NAME"],
+            extra_body={"separate_reasoning": True},
+            reasoning_effort="high",
+            timeout=request_timeout(sum(len(message["content"]) for message in messages)),
+        )
+
+    def translation_units(self, data) -> list[str]:
+        return [str(message["content"]) for message in data["messages"] if message["content"] != ""]
+
+    async def warm_cache(self) -> int:
+        warmed = 0
+        for content, source in self._cur.execute(
+                "SELECT content, source FROM result WHERE source IS NOT NULL;").fetchall():
+            # process() と同じ順序で会話履歴を組み立て直す
+            original_messages = []
+            translated_messages = []
+            for message, translated in zip(json.loads(source), json.loads(content)):
+                original_messages.append(message.copy())
+                if message["content"] != "" and translated["content"] != "<-- output is missing -->":
+                    messages = self._messages(original_messages, translated_messages, message)
+                    with warming(completion_response(translated, os.environ["MODEL_NAME"])):
+                        await self._translate(messages)
+                    warmed += 1
+                translated_messages.append(translated)
+        return warmed
+
     async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm):
-        # id列に order の値が存在するか確認、したらスキップ
-        if self._cur.execute("SELECT COUNT(*) FROM result WHERE id=?;", (order,)).fetchone()[0] > 0:
-            bar.update(1)
-            return
         async with sem:
             input_json = data["messages"]
 
@@ -47,54 +112,27 @@ class Task(InferenceTask):
                 if message["content"] == "":
                     translated_messages.append(message.copy())
                     continue
-                sleep_time = 4.0
-                while True:
-                    try:
-                        chat_string = "過去の会話履歴(一貫性のある翻訳のためのコンテキスト):\n\n\n" + \
-                            "\n\n\n".join(filter(None,[
-                            f"===={orig['role']}=============\n" +
-                            (orig['content'] or "") +
-                            "\n\n-------↓↓↓↓↓↓-------\n\n" +
-                            (trans['content'] or "") +
-                            "\n============================="
-                            if (orig["content"] or "") != "" else None for orig, trans in
-                            zip(original_messages, translated_messages)
-                        ])) + "\n\n\n\n" + \
-                        "以下に外国語の文章Aが与えられます。その文章を全て日本語に翻訳してください。なお、以下の条件を**遵守**すること。\n" + \
-                        "\n" + \
-                        " - 人名については翻訳せず、原文での表記のまま書くこと。\n" + \
-                        " - 原文に忠実に翻訳し、原文に存在する情報を欠落させたり、書かれていないことを付け加えないこと。\n" + \
-                        " - 原文の雰囲気や文脈に基づいて翻訳すること。\n" + \
-                        " - 翻訳済みの文章のみを出力し、余計な説明や注釈を加えないこと。\n\n" + \
-                        "\n===文章A==========================\n\n\n" + str(message["content"])
-                        # print(f"{chat_string}")
-
-                        resp = await self._client.chat.completions.create(
-                            messages=[
-                            ChatCompletionUserMessageParam(
-                                content=chat_string,
-                                role="user"
-                            )],
-                            model=os.environ["MODEL_NAME"],
-                            extra_body={"separate_reasoning": True},
-                            reasoning_effort="high",
-                        )
-                        translated_messages.append(resp.choices[0].message.to_dict())
-                        break
-                    except OpenAIError as e:
-                        if sleep_time > 16.0:
-                            translated_messages.append({"role": "assistant", "content": "<-- output is missing -->"})
-                            break
-                        print(f"OpenAI API Error: {e}")
-                        await asyncio.sleep(sleep_time)
-                        sleep_time *= 2
+                messages = self._messages(original_messages, translated_messages, message)
+                # print(f"{messages}")
+
+                async def translate() -> dict:
+                    resp = await call_with_retry(lambda: self._translate(messages), sem)
+                    return resp.choices[0].message.to_dict()
+
+                try:
+                    translated_messages.append(await deduplicator.once(str(message["content"]), translate, sem))
+                except OpenAIError as e:
+                    if is_outage_error(e):
+                        # 障害中の失敗は欠損として書き込まず、レコードごと失敗させて --resume でやり直す
+                        raise
+                    print(f"OpenAI API Error: {e}")
+                    translated_messages.append({"role": "assistant", "content": "<-- output is missing -->"})
             # print(json.dumps(output_json, ensure_ascii=False))
             for i in range(input_json.__len__()):
                 translated_messages[i].update(role=input_json[i]["role"])
-        self._cur.execute("REPLACE INTO result(id, content, source) VALUES (?,?,?);",
-            (order,
-             json.dumps(translated_messages, ensure_ascii=False),
-             json.dumps(input_json.copy(), ensure_ascii=False)),
-        )
-        self._db.commit()
         bar.update(1)
+        return ResultRow("result", {
+            "id": order,
+            "content": json.dumps(translated_messages, ensure_ascii=False),
+            "source": json.dumps(input_json.copy(), ensure_ascii=False),
+        })
@@ -0,0 +1,83 @@
+import json
+import os
+import random
+import sqlite3
+from os import path
+from os.path import dirname
+import tqdm
+from openai import OpenAIError
+from openai.types.chat import ChatCompletionUserMessageParam
+
+from client import create_client, request_timeout
+from core import InferenceTask, ResultRow
+from retry import call_with_retry
+from streaming import chat_completion
+from asyncio import Semaphore
+
+from projects.example_3_chat.model import RootModel
+
+# プロンプトの本文に並べる単語
+_WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliett", "kilo", "lima")
+
+
+class Task(InferenceTask):
+    """Synthetic records for benchmarking the framework against ``benchmarks/mock_server.py``.
+
+    Each record is one ``chat.completions.parse`` call with the ``RootModel``
+    response format of example_3_chat, so the run exercises the same client,
+    retry, streaming and writer paths as the real projects without a dataset
+    download. Configured by ``BENCHMARK_RECORDS``, ``BENCHMARK_PROMPT_CHARS``
+    and ``BENCHMARK_DB``.
+    """
+
+    def __init__(self):
+        self.db_path = os.environ.get("BENCHMARK_DB", path.join(dirname(__file__), "db.sqlite"))
+        self._db = sqlite3.connect(self.db_path)
+        self.result_table = "result"
+        self._cur = self._db.cursor()
+        self.dataset = range(int(os.environ.get("BENCHMARK_RECORDS", "1000")))
+        self._cur.execute("CREATE TABLE IF NOT EXISTS result(id INT PRIMARY KEY,content TEXT,source TEXT);")
+        self._client = create_client()
+
+    def get_length(self) -> int:
+        return len(self.dataset)
+
+    def __del__(self):
+        self._db.commit()
+        self._cur.close()
+        self._db.close()
+
+    @staticmethod
+    def prepare(data) -> str:
+        # order ごとに決まった内容 (レジュームしても同じリクエストになる)
+        rng = random.Random(data)
+        prompt_chars = int(os.environ.get("BENCHMARK_PROMPT_CHARS", "2000"))
+        words = []
+        length = 0
+        while length < prompt_chars:
+            words.append(rng.choice(_WORDS))
+            length += len(words[-1]) + 1
+        return " ".join(words)
+
+    async def process(self, source, order: int, sem: Semaphore, bar: tqdm.tqdm):
+        async with sem:
+            messages = [ChatCompletionUserMessageParam(content=source, role="user")]
+            try:
+                resp = await call_with_retry(lambda: chat_completion(
+                    self._client, len(source),
+                    messages=messages,
+                    response_format=RootModel,
+                    model=os.environ["MODEL_NAME"],
+                    extra_body={"separate_reasoning": True},
+                    timeout=request_timeout(len(source)),
+                ), sem)
+                content = resp.choices[0].message.parsed.model_dump()
+            except OpenAIError as e:
+                print(f"OpenAI API Error: {e}")
+                content = None
+        bar.update(1)
+        return ResultRow("result", {
+            "id": order,
+            "content": json.dumps(content, ensure_ascii=False),
+            "source": source,
+        })
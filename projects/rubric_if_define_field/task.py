@@ -6,28 +6,33 @@ import asyncio
 from os import path
 from os.path import dirname, basename
 from pathlib import Path
+from typing import Any
 
 import jsonpath_ng
 import tqdm
 from datasets import load_dataset
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError
+from openai import OpenAIError
 from openai.types.chat import ChatCompletionUserMessageParam, ChatCompletionAssistantMessageParam
 from pydantic import BaseModel
 
-from core import InferenceTask
+from client import create_client, request_timeout
+from core import InferenceTask, ResultRow
+from retry import call_with_retry
 from asyncio import Semaphore
 
 
 class Task(InferenceTask):
     def __init__(self):
-        self._db = sqlite3.connect(path.join(dirname(__file__), "db.sqlite"))
+        self.db_path = path.join(dirname(__file__), "db.sqlite")
+        self._db = sqlite3.connect(self.db_path)
+        self.result_table = "result"
         self._cur = self._db.cursor()
         self.dataset = load_dataset("NovelHacja/RubricHub_v1_config", "instruction_following", split="train",
                                     streaming=False)
         self._cur.execute("CREATE TABLE IF NOT EXISTS result(id INT PRIMARY KEY,content TEXT,source TEXT,reason TEXT);")
         load_dotenv(path.join(dirname(__file__), ".env"))
-        self._client = AsyncOpenAI(api_key=os.environ["API_KEY"], base_url=os.environ["BASE_URL"], timeout=None)
+        self._client = create_client()
         self.function_definitions = {basename(_file).removesuffix(".py") for _file in
                                      glob.glob(path.join(dirname(__file__), "functions", "*.py"))}
 
@@ -52,82 +57,88 @@ class Task(InferenceTask):
         else:
             return json_obj
 
-    async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm):
-        # id列に order の値が存在するか確認、したらスキップ
-        if self._cur.execute("SELECT COUNT(*) FROM result WHERE id=?;", (order,)).fetchone()[0] > 0:
-            bar.update(1)
-            return
-        async with sem:
-            input_json = data["extra_info"].copy()
-            input_json = self.shrink_long_string_of_json(input_json)
-            prompt = """以下のJSONデータはRL用のリワードモデルのデータセットです。データセットを翻訳するにあたって、まず、翻訳する必要のあるフィールドを列挙する必要があります。
+    def prepare(self, data) -> dict[str, Any]:
+        input_json = data["extra_info"].copy()
+        input_json = self.shrink_long_string_of_json(input_json)
+        prompt = """以下のJSONデータはRL用のリワードモデルのデータセットです。データセットを翻訳するにあたって、まず、翻訳する必要のあるフィールドを列挙する必要があります。
             翻訳する必要のあるフィールドをJSONPathの形式のテキストのリストで全て列挙してください。必ずルート記述子`$`をつけてください。
             翻訳する必要のあるフィールドは全て文字列型です。
             フィルタ演算やワイルドカードを用いず、単純な子孫アクセスや配列アクセスのみを用いて、翻訳する必要のあるフィールドを特定してください。
             翻訳する必要のあるフィールドは、
             `$.prompt[*].role`,`$.reward_model.rubrics[*].tags.function`,`$.reward_model.rubrics[*].tags.verifier`
             """
-            _functions = []
-            for _function in jsonpath_ng.parse("$.reward_model.rubrics[*].function").find(input_json):
-                if _function in self.function_definitions:
-                    _functions.append(Path(__file__).parent.joinpath("functions", _function + ".py").read_text())
-            if _functions:
-                prompt += "\n\n以下にバリデーション用関数の実装を示すので参考にしてください。\n" + "\n".join(
-                    _functions)
+        _functions = []
+        for _function in jsonpath_ng.parse("$.reward_model.rubrics[*].function").find(input_json):
+            if _function in self.function_definitions:
+                _functions.append(Path(__file__).parent.joinpath("functions", _function + ".py").read_text())
+        if _functions:
+            prompt += "\n\n以下にバリデーション用関数の実装を示すので参考にしてください。\n" + "\n".join(
+                _functions)
+
+        prompt += "\n=======JSONデータ=======\n\n" + json.dumps(input_json, ensure_ascii=False, indent=2)
+        return {
+            "input_json": input_json,
+            "prompt": prompt,
+            "source": json.dumps(data["extra_info"], ensure_ascii=False),
+        }
 
-            prompt += "\n=======JSONデータ=======\n\n" + json.dumps(input_json, ensure_ascii=False, indent=2)
-            sleep_time = 4.0
+    async def process(self, prepared, order: int, sem: Semaphore, bar: tqdm.tqdm):
+        async with sem:
+            # プロンプトは prepare() でイベントループの外で組み立ててある
+            input_json = prepared["input_json"]
+            prompt = prepared["prompt"]
             messages = [
                 ChatCompletionUserMessageParam(
                     content=prompt,
                     role="user"
                 )
             ]
-            while True:
-                try:
-                    resp = await self._client.chat.completions.parse(
-                        messages=messages,
-                        model=os.environ["MODEL_NAME"],
-                        extra_body={"separate_reasoning": True},
-                        reasoning_effort="high",
-                        response_format=self.Paths
-                    )
-                    messages.append(resp.choices[0].message.model_dump())
-                    if resp.choices[0].message.parsed is None:
-                        raise OpenAIError("Failed to parse response: ", resp.choices[0].message)
-                    _unexisting_paths = []
-                    _unexpected_paths = []
-                    for _path in resp.choices[0].message.parsed.json_paths:
-                        if jsonpath_ng.parse(_path).find(input_json).__len__() == 0:
-                            _unexisting_paths.append(_path)
-                    for _path in resp.choices[0].message.parsed.json_paths:
-                        if jsonpath_ng.parse(_path).find(input_json).__len__() != 0 and \
-                                not isinstance(jsonpath_ng.parse(_path).find(input_json)[0], str):
-                            _unexpected_paths.append(_path)
-                    messages.append(ChatCompletionUserMessageParam(
-                        content=f"以下のJSONPathは入力JSONのどの要素にもマッチしませんでした。再確認して、全て出力しなおしてください。"
-                                f"JSONPath: {', '.join(_unexisting_paths)}\n"
-                                f"以下のJSONPathは文字列型に一致しませんでした。再確認して、全て出力しなおしてください。"
-                                f"JSONPath: {', '.join(_unexpected_paths)}\n"
-                        ,
-                        role="user"
-                    ))
-                    if _unexisting_paths:
-                        raise ValueError(f"JSONPath '{_path}' does not match any element in the input JSON.")
-                    break
-                except (OpenAIError, ValueError) as e:
-                    if sleep_time > 32.0:
-                        print(f"OpenAI API Error: {e}")
-                        bar.update(1)
-                        return
-                    await asyncio.sleep(sleep_time)
-                    sleep_time *= 2
 
-        self._cur.execute("REPLACE INTO result(id, content, source,reason) VALUES (?,?,?,?);",
-                          (order,
-                           json.dumps(resp.choices[0].message.parsed.json_paths, ensure_ascii=False),
-                           json.dumps(data["extra_info"], ensure_ascii=False),
-                           resp.choices[0].message.reasoning_content),
-                          )
-        self._db.commit()
+            async def request():
+                resp = await self._client.chat.completions.parse(
+                    messages=messages,
+                    model=os.environ["MODEL_NAME"],
+                    extra_body={"separate_reasoning": True},
+                    reasoning_effort="high",
+                    response_format=self.Paths,
+                    timeout=request_timeout(len(prompt))
+                )
+                messages.append(resp.choices[0].message.model_dump())
+                if resp.choices[0].message.parsed is None:
+                    raise OpenAIError("Failed to parse response: ", resp.choices[0].message)
+                _unexisting_paths = []
+                _unexpected_paths = []
+                for _path in resp.choices[0].message.parsed.json_paths:
+                    if jsonpath_ng.parse(_path).find(input_json).__len__() == 0:
+                        _unexisting_paths.append(_path)
+                for _path in resp.choices[0].message.parsed.json_paths:
+                    if jsonpath_ng.parse(_path).find(input_json).__len__() != 0 and \
+                            not isinstance(jsonpath_ng.parse(_path).find(input_json)[0], str):
+                        _unexpected_paths.append(_path)
+                messages.append(ChatCompletionUserMessageParam(
+                    content=f"以下のJSONPathは入力JSONのどの要素にもマッチしませんでした。再確認して、全て出力しなおしてください。"
+                            f"JSONPath: {', '.join(_unexisting_paths)}\n"
+                            f"以下のJSONPathは文字列型に一致しませんでした。再確認して、全て出力しなおしてください。"
+                            f"JSONPath: {', '.join(_unexpected_paths)}\n"
+                    ,
+                    role="user"
+                ))
+                if _unexisting_paths:
+                    raise ValueError(f"JSONPath '{_path}' does not match any element in the input JSON.")
+                return resp
+
+            # 失敗した応答と指摘はmessagesに残したまま再試行する
+            try:
+                resp = await call_with_retry(request, sem, retry_on=(OpenAIError, ValueError))
+            except (OpenAIError, ValueError) as e:
+                print(f"OpenAI API Error: {e}")
+                bar.update(1)
+                return
+
         bar.update(1)
+        return ResultRow("result", {
+            "id": order,
+            "content": json.dumps(resp.choices[0].message.parsed.json_paths, ensure_ascii=False),
+            "source": prepared["source"],
+            "reason": resp.choices[0].message.reasoning_content,
+        })
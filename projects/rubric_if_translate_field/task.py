@@ -8,16 +8,20 @@ import asyncio
 from os import path
 from os.path import dirname, basename
 from pathlib import Path
-from typing import Iterator
+from typing import Any, Iterator
 
 import jsonpath_ng
 import tqdm
 from datasets import load_dataset
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError
+from openai import OpenAIError
 from openai.types.chat import ChatCompletionUserMessageParam, ChatCompletionAssistantMessageParam, \
     ChatCompletionMessageParam
-from core import InferenceTask
+from client import create_client, request_timeout
+from core import InferenceTask, ResultRow
+from dedup import deduplicator
+import rubric_fields
+from retry import call_with_retry
 from asyncio import Semaphore
 
 
@@ -52,13 +56,15 @@ def _define_fields(json_obj: dict, available_args: dict[str, list[str]]) -> list
 
 class Task(InferenceTask):
     def __init__(self):
-        self._db = sqlite3.connect(Path(__file__).parent.joinpath("db.sqlite"))
+        self.db_path = str(Path(__file__).parent.joinpath("db.sqlite"))
+        self._db = sqlite3.connect(self.db_path)
+        self.result_table = "translate"
         self._cur = self._db.cursor()
         self._cur.execute(
             "CREATE TABLE IF NOT EXISTS translate(id INT PRIMARY KEY,content TEXT,loc TEXT,source TEXT,reason TEXT);"
         )
         load_dotenv(path.join(dirname(__file__), ".env"))
-        self._client = AsyncOpenAI(api_key=os.environ["API_KEY"], base_url=os.environ["BASE_URL"], timeout=None)
+        self._client = create_client()
         self.function_definitions = _parse_function_definitions(
             Path(__file__).parent.joinpath("functions").glob("*.py"))
         self.dataset = load_dataset("NovelHacja/RubricHub_v1_config", "instruction_following", split="train",
@@ -73,12 +79,31 @@ class Task(InferenceTask):
         self._cur.close()
         self._db.close()
 
-    async def process(self, data, order: int, sem: Semaphore, bar: tqdm.tqdm):
-        # id列に order の値が存在するか確認、したらスキップ
+    def translation_units(self, data) -> list[str]:
+        prepared = self.prepare(data)
+        if prepared is None:
+            # process() で処理されないレコード
+            return []
+        return [str(_match.value) for _match in prepared["matches"].values()]
+
+    def prepare(self, data) -> dict[str, Any] | None:
         data = data["extra_info"].copy()
-        if self._cur.execute("SELECT COUNT(*) FROM translate WHERE id=?;", (order,)).fetchone()[0] > 0:
-            bar.update(1)
-            return
+        source = json.dumps(data, ensure_ascii=False)
+        if source.__len__() > 30000:
+            return None
+        _positions = _define_fields(data, self.function_definitions)
+        # jsonpath の構文解析は重いのでフィールドごとに1回だけ行う
+        _paths = {_pos: jsonpath_ng.parse(_pos) for _pos in _positions}
+        return {
+            "data": data,
+            "source": source,
+            "indented": json.dumps(data, ensure_ascii=False, indent=2),
+            "positions": _positions,
+            "paths": _paths,
+            "matches": {_pos: _path.find(data)[0] for _pos, _path in _paths.items()},
+        }
+
+    async def process(self, prepared, order: int, sem: Semaphore, bar: tqdm.tqdm):
         async with sem:
             elaborate_prompt = """日本語への翻訳タスクです。以降、外国語の翻訳対象の文章が与えられます。その文章を日本語に翻訳するにあたって、全体的な文脈や方針・注意すべきと思われる点を全ての条件について具体的にどのような訳語を用いるべきかについてまで、確実と言い切れるまで** 何度も **推敲してください。なお、議論にあたっては以下の条件を**遵守**すること。
 
@@ -88,16 +113,18 @@ class Task(InferenceTask):
  - 翻訳履歴を参照し、原文の雰囲気や文脈に基づいて一貫性のある翻訳を作成すること。
  - 推敲とは原文の文脈を分析し、次に多義語の選択肢を挙げ、最後に最も適切な表現を決定するプロセスを順を追って説明することです。
  - 最終的な翻訳結果自体は出力しないでください。"""
-            if json.dumps(data, ensure_ascii=False).__len__() > 30000:
+            if prepared is None:
                 bar.update(1)
                 return
+            data = prepared["data"]
             _contents = []
             _reasons = []
-            _positions = []
-            for _translate_pos in _define_fields(data, self.function_definitions):
-                _positions.append(_translate_pos)
-                subject_txt = jsonpath_ng.parse(_translate_pos).find(data)[0]
-                prompt = f"""{json.dumps(data, ensure_ascii=False, indent=2)}
+            _positions = prepared["positions"]
+
+            async def translate_pos(_translate_pos: str) -> tuple[str, str, str]:
+                subject_txt = prepared["matches"][_translate_pos]
+                unit = str(subject_txt.value)
+                prompt = f"""{prepared["indented"]}
 
 上に示すデータセットのうち、{_translate_pos}に該当する部分について処理します。
 
@@ -107,33 +134,35 @@ class Task(InferenceTask):
 {elaborate_prompt}
 ======={_translate_pos}=======
 {subject_txt}"""
-                sleep_time = 4.0
-                while True:
-                    try:
-                        prompts: list[ChatCompletionMessageParam] = [ChatCompletionUserMessageParam(
-                            content=prompt,
-                            role="user"
-                        )]
-                        resp_1 = await self._client.chat.completions.create(
-                            messages=prompts,
-                            model=os.environ["MODEL_NAME"],
-                            extra_body={
-                                "top_k": 20,
-                                "chat_template_kwargs": {"enable_thinking": False},
-                            },
-                            temperature=0.8,
-                            top_p=0.95,
-                        )
+                async def translate_field() -> tuple[str, str, str]:
+                    prompts: list[ChatCompletionMessageParam] = [ChatCompletionUserMessageParam(
+                        content=prompt,
+                        role="user"
+                    )]
+                    resp_1 = await call_with_retry(lambda: self._client.chat.completions.create(
+                        messages=prompts,
+                        model=os.environ["MODEL_NAME"],
+                        extra_body={
+                            "top_k": 20,
+                            "chat_template_kwargs": {"enable_thinking": False},
+                        },
+                        temperature=0.8,
+                        top_p=0.95,
+                        timeout=request_timeout(len(prompt)),
+                    ), sem)
 
-                        prompts.append(ChatCompletionAssistantMessageParam(
-                            content=resp_1.choices[0].message.content,
-                            role="assistant"
-                        ))
+                    prompts.append(ChatCompletionAssistantMessageParam(
+                        content=resp_1.choices[0].message.content,
+                        role="assistant"
+                    ))
+                    reason_2 = ""
+                    # --recheck-min-chars より短いフィールドは再確認のターンを省く
+                    if rubric_fields.needs_recheck(unit):
                         prompts.append(ChatCompletionUserMessageParam(
                             content="本当にすべての項目・注意点に対して検討を行ったか確認し、漏れがあれば再検討してください。",
                             role="user"
                         ))
-                        resp_2 = await self._client.chat.completions.create(
+                        resp_2 = await call_with_retry(lambda: self._client.chat.completions.create(
                             messages=prompts,
                             model=os.environ["MODEL_NAME"],
                             extra_body={
@@ -142,44 +171,54 @@ class Task(InferenceTask):
                             },
                             temperature=0.8,
                             top_p=0.95,
-                        )
+                            timeout=request_timeout(len(prompt)),
+                        ), sem)
                         prompts.append(ChatCompletionAssistantMessageParam(
                             content=resp_2.choices[0].message.content,
                             role="assistant"
                         ))
-                        prompts.append(ChatCompletionUserMessageParam(
-                            content="推敲をもとに、全文の和訳のみを出力してください。",
-                            role="user"
-                        ))
-                        last_resp = await self._client.chat.completions.create(
-                            messages=prompts,
-                            model=os.environ["MODEL_NAME"],
-                            extra_body={
-                                "top_k": 20,
-                                "chat_template_kwargs": {"enable_thinking": False},
-                            },
-                            temperature=0.6,
-                            top_p=0.8,
-                        )
-                        break
-                    except (OpenAIError, ValueError) as e:
-                        print(f"OpenAI API Error: {e}")
-                        if sleep_time > 32.0:
-                            bar.update(1)
-                            return
-                        await asyncio.sleep(sleep_time)
-                        sleep_time *= 2
-                _contents.append(last_resp.choices[0].message.content)
-                _reasons.append(resp_1.choices[0].message.content)
-                _reasons.append(resp_2.choices[0].message.content)
+                        reason_2 = resp_2.choices[0].message.content
+                    prompts.append(ChatCompletionUserMessageParam(
+                        content="推敲をもとに、全文の和訳のみを出力してください。",
+                        role="user"
+                    ))
+                    last_resp = await call_with_retry(lambda: self._client.chat.completions.create(
+                        messages=prompts,
+                        model=os.environ["MODEL_NAME"],
+                        extra_body={
+                            "top_k": 20,
+                            "chat_template_kwargs": {"enable_thinking": False},
+                        },
+                        temperature=0.6,
+                        top_p=0.8,
+                        timeout=request_timeout(len(prompt)),
+                    ), sem)
+                    return (last_resp.choices[0].message.content,
+                            resp_1.choices[0].message.content,
+                            reason_2)
+
+                return await deduplicator.once(unit, translate_field, sem)
+
+            def add_result(result: tuple[str, str, str]):
+                content, reason_1, reason_2 = result
+                _contents.append(content)
+                _reasons.append(reason_1)
+                _reasons.append(reason_2)
+
+            # 既定では前のフィールドの翻訳を履歴として順に翻訳する
+            try:
+                await rubric_fields.translate_fields(_positions, translate_pos, sem, add_result)
+            except OpenAIError as e:
+                print(f"OpenAI API Error: {e}")
+                bar.update(1)
+                return
             updated_data = copy.deepcopy(data)
-            [jsonpath_ng.parse(_pos).update(updated_data, _cont) for _cont, _pos in zip(_contents, _positions)]
-            self._cur.execute("REPLACE INTO translate(id, content, loc, source, reason) VALUES (?,?,?,?,?);", (
-                order,
-                json.dumps(updated_data, ensure_ascii=False),
-                json.dumps(_positions, ensure_ascii=False),
-                json.dumps(data, ensure_ascii=False),
-                json.dumps(_reasons, ensure_ascii=False)
-            ))
-            self._db.commit()
+            [prepared["paths"][_pos].update(updated_data, _cont) for _cont, _pos in zip(_contents, _positions)]
             bar.update(1)
+            return ResultRow("translate", {
+                "id": order,
+                "content": json.dumps(updated_data, ensure_ascii=False),
+                "loc": json.dumps(_positions, ensure_ascii=False),
+                "source": prepared["source"],
+                "reason": json.dumps(_reasons, ensure_ascii=False),
+            })
@@ -0,0 +1,34 @@
+from openai.types.chat import ChatCompletionSystemMessageParam, ChatCompletionUserMessageParam
+
+LAYOUTS = ("legacy", "prefix-stable")
+
+# main.py の configure() で上書きされる
+_layout = "legacy"
+
+
+def configure(layout: str = "legacy"):
+    global _layout
+    if layout not in LAYOUTS:
+        raise ValueError(f"unknown prompt layout {layout!r}, expected one of {LAYOUTS}")
+    _layout = layout
+
+
+def prefix_stable() -> bool:
+    """Whether tasks should build their prompts with ``stable_messages()`` (``--prompt-layout prefix-stable``)."""
+    return _layout == "prefix-stable"
+
+
+def stable_messages(instructions: str, unit: str, history: str = "", record: str = "",
+                    system: str = "") -> list[ChatCompletionSystemMessageParam | ChatCompletionUserMessageParam]:
+    """Messages ordered from the most to the least stable segment.
+
+    The system prompt and the fixed instructions, identical for every request of
+    the project, form the system message. The record-level text, the
+    conversation history and the current unit follow in the user message in
+    that order, so consecutive requests share the longest possible prefix in the
+    server's radix cache.
+    """
+    return [
+        ChatCompletionSystemMessageParam(content="\n\n".join(filter(None, [system, instructions])), role="system"),
+        ChatCompletionUserMessageParam(content="\n\n\n\n".join(filter(None, [record, history, unit])), role="user"),
+    ]
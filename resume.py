@@ -0,0 +1,90 @@
+from typing import Any, Iterable, Iterator
+
+from datasets import Dataset
+
+from core import InferenceTask
+from sharding import Shard
+
+
+class ResumeIndex:
+    """Bitmap of completed orders, one bit per dataset row."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.completed = 0
+        self._bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def load(cls, task: InferenceTask, size: int) -> "ResumeIndex":
+        index = cls(size)
+        for order in task.completed_orders():
+            index.add(order)
+        return index
+
+    def add(self, order: int):
+        if not 0 <= order < self.size or order in self:
+            return
+        self._bits[order >> 3] |= 1 << (order & 7)
+        self.completed += 1
+
+    def __contains__(self, order: int) -> bool:
+        return 0 <= order < self.size and bool(self._bits[order >> 3] & (1 << (order & 7)))
+
+    def pending_ranges(self) -> Iterator[range]:
+        """Contiguous runs of orders that are not completed yet."""
+        start = None
+        for byte_index, byte in enumerate(self._bits):
+            if byte == 0xFF and start is None:
+                continue
+            if byte == 0 and start is not None:
+                continue
+            for order in range(byte_index << 3, min((byte_index + 1) << 3, self.size)):
+                if order in self:
+                    if start is not None:
+                        yield range(start, order)
+                        start = None
+                elif start is None:
+                    start = order
+        if start is not None:
+            yield range(start, self.size)
+
+
+def _pending_positions(orders: range, index: ResumeIndex) -> Iterator[range]:
+    """Runs of positions in ``orders`` whose order is not completed yet."""
+    start = None
+    for position, order in enumerate(orders):
+        if order in index:
+            if start is not None:
+                yield range(start, position)
+                start = None
+        elif start is None:
+            start = position
+    if start is not None:
+        yield range(start, len(orders))
+
+
+def pending_items(dataset: Iterable, index: ResumeIndex, shard: Shard | None = None) -> Iterator[tuple[int, Any]]:
+    """(order, item) pairs for rows that still need processing.
+
+    Random-access datasets are read range by range so completed rows are never
+    touched; other iterables are walked and filtered. For a strided ``shard``
+    of a ``Dataset``, the shard's rows are taken with one ``Dataset.shard()``
+    and read range by range within it.
+    """
+    if isinstance(dataset, Dataset) and shard is not None and shard.strided:
+        orders = shard.orders(len(dataset))
+        # 行ごとの select ではなくシャード全体で1つのインデックスマッピングを作る
+        rows = dataset.shard(num_shards=shard.count, index=shard.index, contiguous=False)
+        for pending in _pending_positions(orders, index):
+            yield from zip(orders[pending.start:pending.stop], rows.select(pending))
+    elif isinstance(dataset, Dataset):
+        for pending in index.pending_ranges():
+            # 連続範囲のselectはインデックスマッピングを作らない
+            yield from zip(pending, dataset.select(pending))
+    elif isinstance(dataset, (list, range)):
+        for pending in index.pending_ranges():
+            yield from zip(pending, dataset[pending.start:pending.stop])
+    else:
+        for order, item in enumerate(dataset):
+            if order not in index:
+                yield order, item
@@ -0,0 +1,161 @@
+import asyncio
+import email.utils
+import random
+import time
+from asyncio import Semaphore
+from contextvars import ContextVar
+from typing import Awaitable, Callable, TypeVar
+
+from openai import APIStatusError, OpenAIError
+
+import cache
+import metrics
+import tracing
+from circuit import breaker, is_outage_error
+
+T = TypeVar("T")
+
+# main.py の configure() で上書きされる
+_max_attempts = 4
+_record_retries = 12
+_base_delay = 2.0
+_max_delay = 60.0
+
+
+def configure(max_attempts: int = 4, record_retries: int = 12, base_delay: float = 2.0, max_delay: float = 60.0):
+    global _max_attempts, _record_retries, _base_delay, _max_delay
+    _max_attempts = max(1, max_attempts)
+    _record_retries = max(0, record_retries)
+    _base_delay = base_delay
+    _max_delay = max_delay
+
+
+class RetryBudget:
+    """Number of retries one record may spend across all of its API calls."""
+
+    def __init__(self, retries: int | None = None):
+        self.remaining = _record_retries if retries is None else retries
+
+
+_record_budget: ContextVar[RetryBudget | None] = ContextVar("_record_budget", default=None)
+
+
+def start_record():
+    """Give the current record a fresh retry budget. Called by the scheduler before ``process()``."""
+    _record_budget.set(RetryBudget())
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Everything except client errors (4xx other than 408/409/429), which fail the same way again."""
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return True
+
+
+def retry_after(e: BaseException) -> float | None:
+    """Delay requested by the server through ``retry-after-ms`` / ``Retry-After``."""
+    if not isinstance(e, APIStatusError):
+        return None
+    headers = e.response.headers
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # HTTP-date形式
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, e: BaseException | None = None) -> float:
+    """Full-jitter exponential backoff, never shorter than what the server asked for."""
+    delay = random.uniform(0, min(_max_delay, _base_delay * 2 ** attempt))
+    requested = retry_after(e) if e is not None else None
+    if requested is not None:
+        delay = max(delay, min(requested, _max_delay))
+    return delay
+
+
+async def _wait_for_backend(sem: Semaphore):
+    # 停止中は枠を手放して復旧を待つ
+    sem.release()
+    try:
+        await breaker.wait_closed()
+    finally:
+        await sem.acquire()
+
+
+async def call_with_retry(call: Callable[[], Awaitable[T]], sem: Semaphore,
+                          retry_on: tuple[type[BaseException], ...] = (OpenAIError,)) -> T:
+    """Await ``call()`` and retry on ``retry_on`` errors.
+
+    ``sem`` must be held by the caller. It is released while sleeping between
+    attempts so that a backing-off record does not keep a concurrency slot idle.
+    Gives up (re-raising the last error) after ``max_attempts`` attempts, when the
+    record's retry budget is spent, or on a non-retryable error.
+
+    Outage errors while the circuit breaker is open do not count as attempts:
+    the call waits until the backend is back and is then issued again, with the
+    attempts and budget it had left. A call that runs out of attempts (or
+    budget) on an outage error opens the breaker itself and, once per call,
+    waits for the backend and starts its attempts over instead of giving up.
+    The latency and output tokens of each successful request that reached the
+    API are passed to ``sem.observe`` when ``sem`` is a
+    ``limiter.AdaptiveSemaphore``.
+    """
+    budget = _record_budget.get()
+    if budget is None:
+        budget = RetryBudget()
+        _record_budget.set(budget)
+    observe = getattr(sem, "observe", None)
+    # 連続失敗を呼び出し単位で数えるためのキー
+    call_key = object()
+    attempt = 0
+    waited = False
+    while True:
+        if breaker.is_open:
+            await _wait_for_backend(sem)
+        start = time.monotonic()
+        cache.served_locally.set(False)
+        try:
+            result = await call()
+        except retry_on as e:
+            if breaker.record_failure(e, call_key) and is_outage_error(e):
+                print(f"{type(e).__name__}: {e} (backend down, waiting for recovery)")
+                continue
+            if observe is not None:
+                observe(error=e)
+            attempt += 1
+            if attempt >= _max_attempts or budget.remaining <= 0 or not is_retryable(e):
+                if is_outage_error(e) and not waited and breaker.trip(e):
+                    # 障害で尽きた場合は欠損として返さず、復旧を待ってからもう一巡だけ試す
+                    print(f"{type(e).__name__}: {e} (out of attempts, waiting for the backend)")
+                    waited = True
+                    attempt = 0
+                    continue
+                raise
+            budget.remaining -= 1
+            metrics.retries.inc(type(e).__name__)
+            delay = backoff_delay(attempt, e)
+            tracing.event("retry", error=type(e).__name__, attempt=attempt, delay=delay)
+            print(f"{type(e).__name__}: {e} (retrying in {delay:.1f}s)")
+            sem.release()
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                await sem.acquire()
+        else:
+            if observe is not None and not cache.served_locally.get():
+                # 枠の保持時間ではなくリクエスト単体の所要時間 (生成長の違いは出力トークン数で割って除く)
+                usage = getattr(result, "usage", None)
+                observe(latency=time.monotonic() - start, tokens=getattr(usage, "completion_tokens", None))
+            breaker.record_success()
+            return result
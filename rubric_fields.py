@@ -0,0 +1,42 @@
+from asyncio import Semaphore
+from functools import partial
+from typing import Awaitable, Callable, TypeVar
+
+import fanout
+
+T = TypeVar("T")
+
+# main.py の configure() で設定される (既定は全フィールドを順に翻訳し、常に再確認する)
+_concurrent = False
+_recheck_min_chars = 0
+
+
+def configure(concurrent: bool = False, recheck_min_chars: int = 0):
+    global _concurrent, _recheck_min_chars
+    _concurrent = concurrent
+    _recheck_min_chars = max(0, recheck_min_chars)
+
+
+def needs_recheck(unit: str) -> bool:
+    """Whether the re-check turn runs for ``unit`` (always, unless ``--recheck-min-chars`` is set)."""
+    return len(unit) >= _recheck_min_chars
+
+
+async def translate_fields(positions: list[str], translate: Callable[[str], Awaitable[T]], sem: Semaphore,
+                           done: Callable[[T], None]):
+    """Translate the fields of one ``rubric_if_translate_field*`` record, passing each result to ``done`` in order.
+
+    By default the fields are translated one after another, so every field
+    sees the translations of the earlier ones as history (``done`` adds them).
+    With ``--concurrent-fields`` the prompt fields are translated first, and
+    the rubric fields then go through ``fanout.gather()`` with only the
+    translated prompt as history.
+    """
+    sequential = len(positions)
+    if _concurrent:
+        # _define_fields() は prompt のフィールドを先に返す
+        sequential = len([position for position in positions if position.startswith("$.prompt[")])
+    for position in positions[:sequential]:
+        done(await translate(position))
+    for result in await fanout.gather([partial(translate, position) for position in positions[sequential:]], sem):
+        done(result)
@@ -0,0 +1,137 @@
+import asyncio
+import time
+import traceback
+from asyncio import Queue, Semaphore
+from typing import Any, AsyncIterable, Iterable
+
+import tqdm
+
+import metrics
+import retry
+import tracing
+import usage
+from circuit import breaker
+from core import InferenceTask, ResultRow, current_order
+from database import ResultWriter, WriterError
+from limiter import TokenBudget
+from preprocess import Preparer
+
+# 全ワーカーへの終了通知
+_DONE = object()
+
+
+class Scheduler:
+    """Fixed pool of worker coroutines fed by a bounded queue.
+
+    The producer blocks on ``Queue.put`` when every worker is busy, so at most
+    ``workers`` rows are buffered ahead of dispatch regardless of dataset size.
+    With ``usage_table``, the token usage and wall time of every record that
+    made API calls are written to that table next to its result. With a
+    ``preparer``, ``prepare()`` runs in its pool as soon as a row is read;
+    otherwise it runs on the loop right before ``process()``.
+    """
+
+    def __init__(self, task: InferenceTask, sem: Semaphore, bar: tqdm.tqdm, workers: int,
+                 writer: ResultWriter | None = None, budget: TokenBudget | None = None,
+                 usage_table: str | None = None, preparer: Preparer | None = None):
+        self._task = task
+        self._preparer = preparer
+        self._writer = writer
+        self._usage_table = usage_table if writer is not None else None
+        self._budget = budget
+        self._sem = sem
+        self._bar = bar
+        self._workers = max(1, workers)
+        self._queue: Queue = Queue(maxsize=self._workers)
+        self.failed: list[int] = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def _produce(self, items: Iterable[tuple[int, Any]] | AsyncIterable[tuple[int, Any]]):
+        if isinstance(items, AsyncIterable):
+            # ingest.Prefetcher など別スレッドで読み込まれるもの
+            async for order, item in items:
+                await self._queue.put((order, item, await self._submit(item)))
+        else:
+            for order, item in items:
+                await self._queue.put((order, item, await self._submit(item)))
+        # 読み込みに失敗した場合は run() がワーカーをキャンセルする
+        for _ in range(self._workers):
+            await self._queue.put(_DONE)
+
+    async def _submit(self, item: Any) -> asyncio.Future | None:
+        return await self._preparer.submit(item) if self._preparer is not None else None
+
+    async def _prepared(self, item: Any, future: asyncio.Future | None) -> Any:
+        if future is None:
+            return self._task.prepare(item)
+        return await self._preparer.result(future)  # pyright: ignore[reportOptionalMemberAccess]
+
+    async def _work(self):
+        while True:
+            entry = await self._queue.get()
+            if entry is _DONE:
+                return
+            order, item, future = entry
+            try:
+                # prepare() の失敗もそのレコードの失敗として扱う
+                data = await self._prepared(item, future)
+                # バックエンド停止中は新しいレコードを投入しない
+                await breaker.wait_closed()
+                if self._budget is None:
+                    await self._dispatch(order, data)
+                else:
+                    async with self._budget.reserve(self._task.estimate_tokens(item)):
+                        await self._dispatch(order, data)
+            except WriterError:
+                # 保存できないまま処理を続けても結果は残らないので実行を止める
+                raise
+            except Exception as e:
+                # 1レコードの失敗で実行全体を止めない
+                self.failed.append(order)
+                metrics.records.inc("failed")
+                print(f"order[{order}]: process failed: {e!r}")
+                traceback.print_exception(e)
+                self._bar.update(1)
+                self._bar.set_postfix(failed=len(self.failed))
+
+    async def _dispatch(self, order: int, item: Any):
+        current_order.set(order)
+        retry.start_record()
+        record_usage = usage.start_record()
+        start = time.monotonic()
+        started_at = time.time()
+        try:
+            row = await self._task.process(item, order, self._sem, self._bar)
+        except Exception as e:
+            tracing.event("record", start=started_at, duration=time.monotonic() - start, outcome="failed",
+                          error=type(e).__name__, requests=record_usage.requests)
+            raise
+        status = "completed" if row is not None else "skipped"
+        tracing.event("record", start=started_at, duration=time.monotonic() - start, outcome=status,
+                      requests=record_usage.requests, prompt_tokens=record_usage.prompt_tokens,
+                      completion_tokens=record_usage.completion_tokens)
+        if row is not None and self._writer is not None:
+            # writerが詰まっている間はここで待つ (backpressure)
+            await self._writer.put(row)
+        metrics.records.inc(status)
+        if self._usage_table is not None and record_usage.requests:
+            # 結果を保存しなかったレコードも消費した分は残す
+            await self._writer.put(ResultRow(self._usage_table,
+                                             usage.row_values(self._task.result_id(item, order), record_usage,
+                                                              time.monotonic() - start)))
+
+    async def run(self, items: Iterable[tuple[int, Any]] | AsyncIterable[tuple[int, Any]]):
+        producer = asyncio.create_task(self._produce(items))
+        workers = [asyncio.create_task(self._work()) for _ in range(self._workers)]
+        try:
+            await asyncio.gather(producer, *workers)
+        finally:
+            # データセットの読み込みエラーなどで止まったとき、キューを待つワーカーを残さない
+            for task in (producer, *workers):
+                task.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+        if self.failed:
+            print(f"{len(self.failed)} record(s) failed: {sorted(self.failed)}")
@@ -0,0 +1,133 @@
+import glob
+import re
+import sqlite3
+from os import path
+from typing import Iterator
+
+
+class Shard:
+    """Static partition ``index``/``count`` of the row orders.
+
+    contiguous: shard i owns ``[i * size // count, (i + 1) * size // count)``.
+    strided: shard i owns the orders with ``order % count == i``, which spreads
+    long and short rows evenly when the dataset is sorted by length.
+    """
+
+    def __init__(self, index: int, count: int, strided: bool = False):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"invalid shard {index}/{count}")
+        self.index = index
+        self.count = count
+        self.strided = strided
+
+    @classmethod
+    def parse(cls, spec: str, strided: bool = False) -> "Shard":
+        """``"i/n"`` as given to ``--shard``."""
+        match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", spec)
+        if match is None:
+            raise ValueError(f"--shard expects i/n, got {spec!r}")
+        return cls(int(match.group(1)), int(match.group(2)), strided)
+
+    def orders(self, size: int) -> range:
+        if self.strided:
+            return range(self.index, size, self.count)
+        return range(self.index * size // self.count, (self.index + 1) * size // self.count)
+
+    def db_path(self, db_path: str) -> str:
+        """Shard DB next to the task's DB, e.g. ``db.shard-0-of-4.sqlite``."""
+        stem, ext = path.splitext(db_path)
+        return f"{stem}.shard-{self.index}-of-{self.count}{ext}"
+
+
+def _tables(db: sqlite3.Connection, schema: str = "main") -> dict[str, str]:
+    return dict(db.execute(
+        f"SELECT name, sql FROM {schema}.sqlite_master "
+        "WHERE type='table' AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%';"
+    ).fetchall())
+
+
+def prepare_shard_db(db_path: str, shard_path: str):
+    """Create the tables of ``db_path`` (schema only) in ``shard_path``."""
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(shard_path)
+    try:
+        existing = _tables(dst)
+        for name, sql in _tables(src).items():
+            if name not in existing:
+                dst.execute(sql)
+        dst.commit()
+    finally:
+        src.close()
+        dst.close()
+
+
+def find_shards(db_path: str) -> list[str]:
+    """All shard DBs of ``db_path``. Raises ``ValueError`` unless exactly one full set is present."""
+    stem, ext = path.splitext(db_path)
+    pattern = re.compile(re.escape(stem) + r"\.shard-(\d+)-of-(\d+)" + re.escape(ext) + "$")
+    found: dict[int, dict[int, str]] = {}
+    for shard_path in glob.glob(f"{glob.escape(stem)}.shard-*-of-*{glob.escape(ext)}"):
+        match = pattern.match(shard_path)
+        if match is not None:
+            found.setdefault(int(match.group(2)), {})[int(match.group(1))] = shard_path
+    if not found:
+        raise ValueError(f"no shard DB found for {db_path}")
+    if len(found) > 1:
+        raise ValueError(f"shard DBs of different shard counts found for {db_path}: {sorted(found)}")
+    count, shards = next(iter(found.items()))
+    missing = sorted(set(range(count)) - set(shards))
+    if missing:
+        raise ValueError(f"shard DB(s) {missing} of {count} are missing for {db_path}")
+    return [shards[index] for index in range(count)]
+
+
+def _duplicate_ids(shard_paths: list[str]) -> Iterator[tuple[str, int]]:
+    seen: dict[str, set[int]] = {}
+    for shard_path in shard_paths:
+        db = sqlite3.connect(shard_path)
+        try:
+            for table in _tables(db):
+                ids = seen.setdefault(table, set())
+                for (row_id,) in db.execute(f"SELECT id FROM {table};"):
+                    if row_id in ids:
+                        yield table, row_id
+                    ids.add(row_id)
+        finally:
+            db.close()
+
+
+def merge_shards(db_path: str, shard_paths: list[str]) -> dict[str, int]:
+    """Copy every table of the shard DBs into ``db_path`` and return the merged row count per table.
+
+    Shards must not share an id; if they do, ``ValueError`` is raised before
+    anything is written. Each shard is copied with ``ATTACH`` and one bulk
+    ``INSERT ... SELECT`` per table; rows already in ``db_path`` are replaced.
+    """
+    duplicates = list(_duplicate_ids(shard_paths))
+    if duplicates:
+        raise ValueError(f"{len(duplicates)} id(s) appear in more than one shard, e.g. {duplicates[:10]}")
+    merged: dict[str, int] = {}
+    # ATTACH/DETACHはトランザクション外でしか実行できないので自動コミットモードで開く
+    db = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        existing = _tables(db)
+        for shard_path in shard_paths:
+            db.execute("ATTACH DATABASE ? AS shard;", (shard_path,))
+            try:
+                db.execute("BEGIN;")
+                for table, sql in _tables(db, "shard").items():
+                    if table not in existing:
+                        db.execute(sql)
+                        existing[table] = sql
+                    count = db.execute(f"INSERT OR REPLACE INTO main.{table} SELECT * FROM shard.{table};").rowcount
+                    merged[table] = merged.get(table, 0) + count
+                db.execute("COMMIT;")
+            except BaseException:
+                if db.in_transaction:
+                    db.execute("ROLLBACK;")
+                raise
+            finally:
+                db.execute("DETACH DATABASE shard;")
+    finally:
+        db.close()
+    return merged
@@ -0,0 +1,179 @@
+import asyncio
+import time
+from typing import Any
+
+from openai import AsyncOpenAI, OpenAIError
+
+import metrics
+import tracing
+import usage
+
+# main.py の configure() で上書きされる
+_enabled = False
+_stall_timeout = 60.0
+_max_ratio = 4.0
+_min_chars = 4096
+_ngram = 32
+_repeats = 4
+_min_loop_chars = 512
+_window = 8192
+_check_every = 256
+
+# 打ち切った理由ごとの回数
+aborts: dict[str, int] = {}
+
+
+def configure(enabled: bool = False, stall_timeout: float = 60.0, max_ratio: float = 4.0):
+    """Settings for ``chat_completion()``. main.py calls this before constructing the task."""
+    global _enabled, _stall_timeout, _max_ratio
+    _enabled = enabled
+    _stall_timeout = stall_timeout
+    _max_ratio = max_ratio
+
+
+class DegenerateOutput(OpenAIError):
+    """A streamed completion was cancelled because its output went wrong.
+
+    It is an ``OpenAIError`` so that ``call_with_retry`` samples it again.
+    """
+
+    def __init__(self, reason: str, chars: int):
+        super().__init__(f"streamed output cancelled ({reason}) after {chars} chars")
+        self.reason = reason
+
+
+def _loop_period(tail: str) -> int | None:
+    # 末尾の n-gram が直前に現れた位置との距離を周期の候補にし、末尾がその周期で繰り返しているか確かめる
+    if len(tail) < _ngram * 2:
+        return None
+    key = tail[-_ngram:]
+    previous = tail.rfind(key, 0, len(tail) - 1)
+    if previous < 0:
+        return None
+    period = len(tail) - _ngram - previous
+    span = max(period * _repeats, _min_loop_chars)
+    if span > len(tail):
+        return None
+    loop = tail[-span:]
+    return period if loop[period:] == loop[:-period] else None
+
+
+class OutputMonitor:
+    """Watches streamed text for a repetition loop or for running far past ``max_chars``.
+
+    A loop is the end of the text repeating one unit (of any length up to
+    ``_window / _repeats`` chars) at least ``_repeats`` times and over at least
+    ``_min_loop_chars`` chars. Legitimate output, even repetitive JSON, does not
+    repeat itself verbatim like that.
+    """
+
+    def __init__(self, max_chars: int | None = None):
+        self.max_chars = max_chars
+        self.chars = 0
+        self._tail = ""
+        self._pending: list[str] = []
+        self._pending_chars = 0
+
+    def feed(self, text: str) -> str | None:
+        """Add ``text``; returns why the generation should be cancelled, or ``None``."""
+        self.chars += len(text)
+        if self.max_chars is not None and self.chars > self.max_chars:
+            return "length"
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if self._pending_chars < _check_every:
+            return None
+        self._tail = (self._tail + "".join(self._pending))[-_window:]
+        self._pending.clear()
+        self._pending_chars = 0
+        return "repetition" if _loop_period(self._tail) is not None else None
+
+
+def _delta_texts(chunk) -> tuple[str, str]:
+    content = []
+    reasoning = []
+    for choice in chunk.choices:
+        delta = choice.delta
+        if delta.content:
+            content.append(delta.content)
+        # vLLM / SGLang は推論を reasoning_content (または reasoning) で返す
+        text = getattr(delta, "reasoning_content", None) or getattr(delta, "reasoning", None)
+        if isinstance(text, str):
+            reasoning.append(text)
+    return "".join(content), "".join(reasoning)
+
+
+def _abort(reason: str, monitor: OutputMonitor, start: float) -> DegenerateOutput:
+    aborts[reason] = aborts.get(reason, 0) + 1
+    metrics.stream_aborts.inc(reason)
+    # 打ち切ったリクエストの使用量は分からないが、時間は数える
+    usage.record(None, time.monotonic() - start)
+    return DegenerateOutput(reason, monitor.chars)
+
+
+async def chat_completion(client: AsyncOpenAI, expected_output_length: int, **kwargs: Any):
+    """``chat.completions.create`` (or ``parse`` when ``response_format`` is given) with an early abort.
+
+    Without ``--stream`` this is the plain call. With it the completion is
+    streamed and cancelled, raising ``DegenerateOutput``, as soon as the output
+    loops, grows past ``--stream-max-ratio`` times ``expected_output_length``
+    chars, or no chunk arrives for ``--stream-stall-timeout`` seconds. Closing
+    the stream drops the connection, so the server stops generating at once.
+    Returns the same completion object as the non-streaming call. Streamed
+    calls are accounted in ``usage`` here, since the transport does not parse
+    event streams.
+    """
+    response_format = kwargs.get("response_format")
+    if not _enabled:
+        if response_format is None:
+            return await client.chat.completions.create(**kwargs)
+        return await client.chat.completions.parse(**kwargs)
+    if response_format is None:
+        kwargs.pop("response_format", None)
+    kwargs.setdefault("stream_options", {"include_usage": True})
+    max_chars = max(_min_chars, int(expected_output_length * _max_ratio)) if _max_ratio > 0 else None
+    content = OutputMonitor(max_chars)
+    reasoning = OutputMonitor()
+    start = time.monotonic()
+    started_at = time.time()
+    ttft = None
+    try:
+        async with client.chat.completions.stream(**kwargs) as stream:
+            events = stream.__aiter__()
+            while True:
+                try:
+                    # 最初のチャンクまではキューと prefill の待ちなので read timeout に任せる
+                    event = await asyncio.wait_for(anext(events), _stall_timeout if ttft is not None else None)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise _abort("stall", content, start) from None
+                if ttft is None:
+                    ttft = time.monotonic() - start
+                    metrics.time_to_first_token.observe(ttft)
+                if event.type != "chunk":
+                    continue
+                content_text, reasoning_text = _delta_texts(event.chunk)
+                reason = content.feed(content_text) if content_text else None
+                if reason is None and reasoning_text:
+                    reason = reasoning.feed(reasoning_text)
+                    if reason is not None:
+                        raise _abort(f"reasoning {reason}", reasoning, start)
+                if reason is not None:
+                    raise _abort(reason, content, start)
+            completion = await stream.get_final_completion()
+    except DegenerateOutput as e:
+        tracing.event("request", **tracing.last_stream(), start=started_at, ttfb=ttft,
+                      duration=time.monotonic() - start, outcome="aborted", error=e.reason, stream=True)
+        raise
+    completion_usage = completion.usage.model_dump() if completion.usage is not None else None
+    usage.record(completion_usage, time.monotonic() - start)
+    tracing.event("request", **tracing.last_stream(), start=started_at, ttfb=ttft,
+                  duration=time.monotonic() - start, outcome="ok", stream=True, **usage.trace_values(completion_usage))
+    return completion
+
+
+def summary() -> str | None:
+    if not aborts:
+        return None
+    return "streaming: cancelled " + ", ".join(f"{count} ({reason})" for reason, count in sorted(aborts.items()))
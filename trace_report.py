@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Trace Report Script for main.py --trace files
+
+This script summarizes the JSONL traces written by ``main.py --trace`` to show
+where the time of a run goes: API latency (prefill/decode), retries, parse
+failures in multi-turn projects, or DB writes.
+
+Usage:
+    python trace_report.py <trace.jsonl> [more traces...] [--top N] [--project NAME]
+
+Output includes:
+- Event and request outcome counts, tokens
+- Request latency and time-to-first-byte percentiles by project, turn and request size
+- Retries by error class and parse errors by turn
+- Record duration percentiles and the slowest records
+- DB writer batch timings
+"""
+
+import argparse
+import json
+import sys
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# リクエストサイズ (bytes) の区切り
+SIZE_BUCKETS = [(4 << 10, "<4K"), (16 << 10, "4K-16K"), (64 << 10, "16K-64K"), (256 << 10, "64K-256K")]
+
+
+def load_events(paths: List[str]) -> List[Dict[str, Any]]:
+    """Read every event of the given trace files, skipping lines that are not JSON (e.g. a torn last line)."""
+    events = []
+    for trace_path in paths:
+        with open(trace_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    return events
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Linear-interpolated percentile of ``values`` (0 <= p <= 100)."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def size_bucket(request_bytes: Optional[int]) -> str:
+    if request_bytes is None:
+        return "unknown"
+    for bound, label in SIZE_BUCKETS:
+        if request_bytes < bound:
+            return label
+    return ">=256K"
+
+
+def print_header(title: str):
+    print(f"\n{'='*80}")
+    print(title)
+    print(f"{'='*80}")
+
+
+def print_latency_table(title: str, groups: Dict[Tuple, List[float]], key_names: Tuple[str, ...]):
+    """Print count, mean and p50/p90/p99/max (seconds) for every group."""
+    print(f"\n{title}:")
+    if not groups:
+        print("  (no data)")
+        return
+    key_width = max(len(" / ".join(key_names)), *(len(" / ".join(map(str, key))) for key in groups))
+    print(f"  {' / '.join(key_names):<{key_width}} {'count':>8} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    print(f"  {'-'*key_width} {'-'*8} {'-'*9} {'-'*9} {'-'*9} {'-'*9} {'-'*9}")
+    for key, values in sorted(groups.items(), key=lambda item: tuple(map(str, item[0]))):
+        print(f"  {' / '.join(map(str, key)):<{key_width}} {len(values):>8,} {sum(values) / len(values):>9.2f} "
+              f"{percentile(values, 50):>9.2f} {percentile(values, 90):>9.2f} {percentile(values, 99):>9.2f} "
+              f"{max(values):>9.2f}")
+
+
+def group(events: Iterable[Dict[str, Any]], keys: Tuple[str, ...], value: str) -> Dict[Tuple, List[float]]:
+    groups: Dict[Tuple, List[float]] = defaultdict(list)
+    for event in events:
+        if event.get(value) is not None:
+            groups[tuple(event.get(key, "-") if key != "size" else size_bucket(event.get("request_bytes"))
+                         for key in keys)].append(event[value])
+    return groups
+
+
+def print_summary(events: List[Dict[str, Any]]):
+    print_header("Summary")
+    kinds = Counter(event.get("kind") for event in events)
+    print("\nEvents:")
+    for kind, count in kinds.most_common():
+        print(f"  {kind}: {count:,}")
+    requests = [event for event in events if event.get("kind") == "request"]
+    print("\nRequest outcomes:")
+    for outcome, count in Counter(event.get("outcome") for event in requests).most_common():
+        print(f"  {outcome}: {count:,} ({count / len(requests) * 100:.1f}%)")
+    starts = [event["ts"] for event in events if "ts" in event]
+    if starts:
+        print(f"\nTime span: {max(starts) - min(starts):,.0f}s")
+    print("\nTokens:")
+    for name in ("prompt_tokens", "cached_tokens", "completion_tokens", "reasoning_tokens"):
+        print(f"  {name}: {sum(event.get(name) or 0 for event in requests):,}")
+
+
+def print_requests(events: List[Dict[str, Any]]):
+    requests = [event for event in events if event.get("kind") == "request"]
+    ok = [event for event in requests if event.get("outcome") == "ok"]
+    print_header("API requests (successful)")
+    print_latency_table("Latency by project (s)", group(ok, ("project",), "duration"), ("project",))
+    print_latency_table("Time to first byte by project (s)", group(ok, ("project",), "ttfb"), ("project",))
+    print_latency_table("Latency by turn (s)", group(ok, ("project", "variant", "turn"), "duration"),
+                        ("project", "variant", "turn"))
+    print_latency_table("Latency by request size (s)", group(ok, ("project", "size"), "duration"),
+                        ("project", "size"))
+    print_latency_table("Latency by endpoint (s)", group(ok, ("endpoint",), "duration"), ("endpoint",))
+    failed = [event for event in requests if event.get("outcome") != "ok"]
+    if failed:
+        print("\nFailed requests by outcome / error:")
+        for (outcome, error), count in Counter((event.get("outcome"), event.get("error", "-"))
+                                               for event in failed).most_common():
+            print(f"  {outcome} / {error}: {count:,}")
+
+
+def print_retries(events: List[Dict[str, Any]]):
+    print_header("Retries and parse errors")
+    retries = [event for event in events if event.get("kind") == "retry"]
+    print(f"\nRetries: {len(retries):,}, total backoff {sum(event.get('delay') or 0 for event in retries):,.0f}s")
+    for error, count in Counter(event.get("error") for event in retries).most_common():
+        print(f"  {error}: {count:,}")
+    parse_errors = [event for event in events if event.get("kind") == "parse_error"]
+    print(f"\nParse errors: {len(parse_errors):,}")
+    for (project, variant, turn, error), count in Counter(
+            (event.get("project"), event.get("variant"), event.get("turn"), event.get("error"))
+            for event in parse_errors).most_common():
+        print(f"  {project} / variant {variant} / turn {turn} / {error}: {count:,}")
+
+
+def print_records(events: List[Dict[str, Any]], top: int):
+    records = [event for event in events if event.get("kind") == "record"]
+    print_header("Records")
+    print_latency_table("Record duration by project and outcome (s)", group(records, ("project", "outcome"), "duration"),
+                        ("project", "outcome"))
+    print(f"\nSlowest {top} records:")
+    print(f"  {'project':<32} {'record':>10} {'duration':>10} {'requests':>9} {'completion':>11} outcome")
+    for event in sorted(records, key=lambda e: e.get("duration") or 0, reverse=True)[:top]:
+        print(f"  {str(event.get('project')):<32} {str(event.get('record')):>10} {event.get('duration') or 0:>10.1f} "
+              f"{event.get('requests') or 0:>9} {event.get('completion_tokens') or 0:>11} {event.get('outcome')}")
+
+
+def print_db_writes(events: List[Dict[str, Any]]):
+    writes = [event for event in events if event.get("kind") == "db_write"]
+    print_header("DB writer")
+    if not writes:
+        print("\n  (no data)")
+        return
+    durations = [event["duration"] for event in writes]
+    print(f"\nBatches: {len(writes):,}, rows: {sum(event.get('rows') or 0 for event in writes):,}")
+    print(f"Batch duration: p50 {percentile(durations, 50):.3f}s, p99 {percentile(durations, 99):.3f}s, "
+          f"max {max(durations):.3f}s, total {sum(durations):,.1f}s")
+    print(f"Max rows pending after a batch: {max(event.get('pending') or 0 for event in writes):,}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize JSONL traces written by main.py --trace",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python trace_report.py trace.jsonl                          # Report everything in the trace
+  python trace_report.py shard-*.jsonl --top 50               # Combine the traces of several shards
+  python trace_report.py trace.jsonl --project example_3_chat  # Only one project
+        """
+    )
+    parser.add_argument("traces", nargs="+", help="Trace files (JSONL)")
+    parser.add_argument("--top", type=int, default=20, help="Number of slowest records to list")
+    parser.add_argument("--project", type=str, default=None, help="Only report events of this project")
+    args = parser.parse_args()
+
+    all_events = load_events(args.traces)
+    if args.project is not None:
+        all_events = [event for event in all_events if event.get("project") == args.project]
+    if not all_events:
+        print("No events found.")
+        sys.exit(1)
+    print_summary(all_events)
+    print_requests(all_events)
+    print_retries(all_events)
+    print_records(all_events, args.top)
+    print_db_writes(all_events)
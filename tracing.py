@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+from core import current_order
+
+# process() 内のステップを表す追加フィールド (turn, variant など)
+_fields: ContextVar[dict[str, Any]] = ContextVar("_fields", default={})
+# 直前のストリームの送信先とサイズ (トランスポートで設定し、streaming が読む)
+_stream_request: ContextVar[dict[str, Any]] = ContextVar("_stream_request", default={})
+
+
+class TraceWriter:
+    """Buffered JSONL writer that never blocks the event loop.
+
+    ``emit()`` only appends the event to an in-memory buffer; a background task
+    hands the buffer to a dedicated thread every ``flush_interval`` seconds,
+    which serializes and appends it to the file. Beyond ``max_pending`` buffered
+    events new ones are dropped (and counted) rather than slowing the run down.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_pending: int = 100_000):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending: list[dict[str, Any]] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-writer")
+        self._file = None
+        self._runner: asyncio.Task | None = None
+        self.written = 0
+        self.dropped = 0
+
+    def emit(self, event: dict[str, Any]):
+        if len(self._pending) >= self._max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(event)
+
+    def _write(self, batch: list[dict[str, Any]]):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write("".join(json.dumps(event, ensure_ascii=False, default=str) + "\n" for event in batch))
+        self._file.flush()
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, batch)
+            self.written += len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self._flush()
+
+    def start(self):
+        self._runner = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+        await self._flush()
+        if self._file is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._file.close)
+        self._executor.shutdown()
+
+
+# main.py の configure() で設定される
+_writer: TraceWriter | None = None
+_project: str | None = None
+
+
+def configure(path: str | None, project: str | None = None):
+    """Enable tracing to ``path`` (``None`` disables it)."""
+    global _writer, _project
+    _writer = TraceWriter(path) if path is not None else None
+    _project = project
+
+
+def enabled() -> bool:
+    return _writer is not None
+
+
+@contextmanager
+def fields(**values: Any):
+    """Add ``values`` (e.g. ``turn``, ``variant``) to every event emitted within this block."""
+    token = _fields.set({**_fields.get(), **values})
+    try:
+        yield
+    finally:
+        _fields.reset(token)
+
+
+def note_stream(endpoint: str, request_bytes: int):
+    _stream_request.set({"endpoint": endpoint, "request_bytes": request_bytes})
+
+
+def last_stream() -> dict[str, Any]:
+    """``endpoint`` and ``request_bytes`` of the last streamed request sent by this task."""
+    return _stream_request.get()
+
+
+def event(kind: str, **values: Any):
+    """Record one event of the current record. Does nothing unless ``--trace`` is given."""
+    if _writer is None:
+        return
+    _writer.emit({"kind": kind, "ts": time.time(), "project": _project, "record": current_order.get(),
+                  **_fields.get(), **values})
+
+
+def start():
+    if _writer is not None:
+        _writer.start()
+
+
+async def close():
+    if _writer is not None:
+        await _writer.close()
+        dropped = f", {_writer.dropped} dropped" if _writer.dropped else ""
+        print(f"trace: {_writer.written} event(s) written to {_writer.path}{dropped}")
@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any
+
+import httpx
+
+import tracing
+
+
+class UsageStats:
+    """Token usage reported by the API, and the wall time of the calls that reported it."""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.reasoning_tokens = 0
+        self.api_time = 0.0
+
+    def add(self, usage: dict | None, wall_time: float = 0.0):
+        self.requests += 1
+        self.api_time += wall_time
+        if not usage:
+            return
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+        self.cached_tokens += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        self.reasoning_tokens += (usage.get("completion_tokens_details") or {}).get("reasoning_tokens") or 0
+
+    def summary(self) -> str:
+        if self.requests == 0:
+            return "usage: no requests"
+        ratio = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        return (f"usage: {self.requests} request(s), {self.prompt_tokens} prompt tokens "
+                f"({self.cached_tokens} cached, {ratio:.1%}), {self.completion_tokens} completion tokens "
+                f"({self.reasoning_tokens} reasoning), {self.api_time:.0f}s in API calls")
+
+
+# プロセス全体で1つ
+stats = UsageStats()
+
+# 現在のレコードの集計 (scheduler が process() の前に設定する)
+_record_usage: ContextVar[UsageStats | None] = ContextVar("_record_usage", default=None)
+
+
+def start_record() -> UsageStats:
+    """Give the current record a fresh ``UsageStats``. Called by the scheduler before ``process()``."""
+    record_usage = UsageStats()
+    _record_usage.set(record_usage)
+    return record_usage
+
+
+def trace_values(usage: dict | None) -> dict:
+    usage = usage or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "reasoning_tokens": (usage.get("completion_tokens_details") or {}).get("reasoning_tokens"),
+    }
+
+
+def endpoint(request: httpx.Request) -> str:
+    # BalancingTransport が書き換えた後の実際の送信先
+    return f"{request.url.scheme}://{request.url.netloc.decode('ascii')}"
+
+
+def record(usage: dict | None, wall_time: float):
+    """Account one API call to the run and to the record being processed."""
+    stats.add(usage, wall_time)
+    record_usage = _record_usage.get()
+    if record_usage is not None:
+        record_usage.add(usage, wall_time)
+
+
+def create_table(db_path: str, table: str):
+    """Companion table with one row of usage per record, next to the task's result table."""
+    db = sqlite3.connect(db_path)
+    try:
+        db.execute(f"CREATE TABLE IF NOT EXISTS {table}(id INT PRIMARY KEY,requests INT,prompt_tokens INT,"
+                   "cached_tokens INT,completion_tokens INT,reasoning_tokens INT,api_time REAL,wall_time REAL);")
+        db.commit()
+    finally:
+        db.close()
+
+
+def row_values(result_id: Any, record_usage: UsageStats, wall_time: float) -> dict:
+    return {
+        "id": result_id,
+        "requests": record_usage.requests,
+        "prompt_tokens": record_usage.prompt_tokens,
+        "cached_tokens": record_usage.cached_tokens,
+        "completion_tokens": record_usage.completion_tokens,
+        "reasoning_tokens": record_usage.reasoning_tokens,
+        "api_time": record_usage.api_time,
+        "wall_time": wall_time,
+    }
+
+
+class Throughput:
+    """Completion tokens per second over the last ``window`` seconds (for the progress bar)."""
+
+    def __init__(self, window: float = 30.0):
+        self.window = window
+        self._samples: deque[tuple[float, int]] = deque()
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        self._samples.append((now, stats.completion_tokens))
+        while len(self._samples) > 2 and self._samples[1][0] <= now - self.window:
+            self._samples.popleft()
+        start, tokens = self._samples[0]
+        return (stats.completion_tokens - tokens) / (now - start) if now > start else 0.0
+
+
+class UsageTransport(httpx.AsyncBaseTransport):
+    """Reads ``usage`` (including cached and reasoning tokens) and the wall time of every chat completion.
+
+    Streamed completions are accounted by ``streaming.chat_completion()`` instead.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.monotonic()
+        started_at = time.time()
+        if not request.url.path.endswith("/chat/completions"):
+            return await self._transport.handle_async_request(request)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception as e:
+            tracing.event("request", endpoint=endpoint(request), start=started_at, duration=time.monotonic() - start,
+                          request_bytes=len(request.content), outcome="error", error=type(e).__name__)
+            raise
+        ttfb = time.monotonic() - start
+        if response.status_code != 200:
+            record(None, time.monotonic() - start)
+            tracing.event("request", endpoint=endpoint(request), start=started_at, ttfb=ttfb, duration=ttfb,
+                          request_bytes=len(request.content), outcome=f"http_{response.status_code}")
+            return response
+        if not response.headers.get("content-type", "").startswith("application/json"):
+            # ストリームは streaming.chat_completion() が記録する
+            tracing.note_stream(endpoint(request), len(request.content))
+            return response
+        try:
+            body = b"".join([chunk async for chunk in response.stream])
+        finally:
+            await response.aclose()
+        # 読み切った本文で作り直す (展開済みの本文はクライアント側でもそのまま使われる)
+        response = httpx.Response(response.status_code, headers=response.headers, content=body,
+                                  extensions=response.extensions)
+        try:
+            usage = json.loads(response.content).get("usage")
+        except (ValueError, AttributeError):
+            usage = None
+        record(usage, time.monotonic() - start)
+        tracing.event("request", endpoint=endpoint(request), start=started_at, ttfb=ttfb,
+                      duration=time.monotonic() - start, request_bytes=len(request.content), outcome="ok",
+                      **trace_values(usage))
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def wrap(transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+    return UsageTransport(transport)